@@ -0,0 +1,270 @@
+# This script measures the throughput of each buffer backend, sending a
+# backlog of RFM2Pi-like samples to local stand-in servers: an emoncms stub,
+# an InfluxDB stub and a minimal MQTT broker.
+#
+# Usage:
+#
+#   python benchmarks/backend_throughput.py [nb_samples]
+#
+# The stand-in servers run in a child process, so that the CPU time measured
+# is that of the buffer only. They only count the samples received, and
+# answer immediately: on a real network, the round trip to the server makes
+# batching and pipelining matter even more.
+#
+# Reported:
+# - samples/s: samples sent divided by the time to empty the buffer
+# - CPU: buffer process CPU time (user + system) per sample
+# - received: samples counted by the server
+
+import sys
+import os
+import json
+import time
+import random
+import logging
+import socket
+import struct
+import urlparse
+import resource
+import threading
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oemgatewaybuffer as ogb
+
+##############
+# Parameters #
+##############
+
+# Number of samples sent per backend
+NB_SAMPLES = 20000
+
+# Number of values per sample
+NB_VALUES = 8
+
+# Logging level, as in production
+LOGLEVEL = logging.WARNING
+
+# Backends: (name, buffer class, runtime settings)
+BACKENDS = [
+    ('emoncms get', 'OemGatewayEmoncmsBuffer', {}),
+    ('emoncms bulk', 'OemGatewayEmoncmsBuffer', {'batchsize': '100'}),
+    ('influxdb', 'OemGatewayInfluxDBBuffer', {'batchsize': '1'}),
+    ('influxdb', 'OemGatewayInfluxDBBuffer', {'batchsize': '1',
+                                              'inflight': '16'}),
+    ('influxdb', 'OemGatewayInfluxDBBuffer', {'batchsize': '100'}),
+    ('influxdb', 'OemGatewayInfluxDBBuffer', {'batchsize': '100',
+                                              'inflight': '4'}),
+    ('mqtt', 'OemGatewayMQTTBuffer', {'batchsize': '1'}),
+    ('mqtt', 'OemGatewayMQTTBuffer', {'batchsize': '1', 'inflight': '16'}),
+    ('mqtt', 'OemGatewayMQTTBuffer', {'batchsize': '100'}),
+    ('mqtt', 'OemGatewayMQTTBuffer', {'batchsize': '100', 'inflight': '4'}),
+    ('mqtt qos 0', 'OemGatewayMQTTBuffer', {'batchsize': '100', 'qos': '0'}),
+    ]
+
+########
+# Code #
+########
+
+class Counter(object):
+    """Number of samples received by a server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, nb_samples):
+        with self.lock:
+            self.count += nb_samples
+
+class StubHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.counter = Counter()
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # Send response in one write (avoids delayed ACK on keep-alive)
+    wbufsize = -1
+
+    def setup(self):
+        # Pipelined responses are written one by one: as real servers do,
+        # send them without waiting for the ACK of the previous one
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubEmoncmsHandler(StubHandler):
+
+    def do_GET(self):
+        # input/post.json: one sample per request
+        self.server.counter.add(1)
+        self._reply()
+
+    def do_POST(self):
+        # input/bulk.json: data=[[t,node,val1,...],...]
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        data = urlparse.parse_qs(body)['data'][0]
+        self.server.counter.add(len(json.loads(data)))
+        self._reply()
+
+    def _reply(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+class StubInfluxDBHandler(StubHandler):
+
+    def do_POST(self):
+        # /write: one sample per line
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        self.server.counter.add(body.count('\n'))
+        self.send_response(204)
+        self.end_headers()
+
+class StubMQTTHandler(SocketServer.StreamRequestHandler):
+    """MQTT broker accepting connections and publications."""
+
+    def setup(self):
+        # See StubHandler
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.StreamRequestHandler.setup(self)
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(1)
+            if not header:
+                return
+            length = 0
+            for shift in range(0, 28, 7):
+                byte = ord(self.rfile.read(1))
+                length |= (byte & 0x7f) << shift
+                if not byte & 0x80:
+                    break
+            data = self.rfile.read(length)
+            packet_type = ord(header) & 0xf0
+            if packet_type == 0x10:
+                # CONNECT: accept
+                self.wfile.write('\x20\x02\x00\x00')
+            elif packet_type == 0x30:
+                # PUBLISH: one sample per line, acknowledge if QoS 1
+                topic_length = struct.unpack('!H', data[:2])[0]
+                payload = data[2 + topic_length:]
+                if ord(header) & 0x06:
+                    packet_id = payload[:2]
+                    payload = payload[2:]
+                    self.wfile.write('\x40\x02' + packet_id)
+                self.server.counter.add(payload.count('\n'))
+            elif packet_type == 0xe0:
+                # DISCONNECT
+                return
+
+class StubMQTTBroker(SocketServer.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 StubMQTTHandler)
+        self.counter = Counter()
+
+def servers(conn):
+    """Run in child process: stand-in servers, answer count requests."""
+
+    stubs = {'OemGatewayEmoncmsBuffer': StubHTTPServer(StubEmoncmsHandler),
+             'OemGatewayInfluxDBBuffer': StubHTTPServer(StubInfluxDBHandler),
+             'OemGatewayMQTTBuffer': StubMQTTBroker()}
+    for server in stubs.itervalues():
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    conn.send(dict((name, server.server_address[1])
+                   for name, server in stubs.iteritems()))
+
+    # Send and reset the number of samples received by a server
+    while True:
+        name = conn.recv()
+        if name is None:
+            return
+        counter = stubs[name].counter
+        with counter.lock:
+            conn.send(counter.count)
+            counter.count = 0
+
+def measure(buffer_type, settings, port, samples):
+    """Send samples with a buffer, return elapsed and CPU time."""
+
+    buf = getattr(ogb, buffer_type)(queue_size=len(samples))
+    buf.name = buffer_type
+    runtime_settings = {'protocol': 'http://',
+                        'domain': '127.0.0.1:%d' % port,
+                        'path': '', 'apikey': 'x' * 32, 'active': 'True'}
+    runtime_settings.update(settings)
+    buf.set(**runtime_settings)
+    for t, data in samples:
+        buf.add_many([data], t)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    start = time.time()
+    buf.start()
+    while buf.status()['queued']:
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu
+    buf.close()
+    return elapsed, cpu
+
+def main():
+
+    logging.basicConfig(level=LOGLEVEL)
+
+    nb_samples = int(sys.argv[1]) if len(sys.argv) > 1 else NB_SAMPLES
+
+    rand = random.Random(0)
+    t = time.time()
+    samples = []
+    for i in range(nb_samples):
+        t += 0.01
+        samples.append([round(t, 2), [rand.randint(1, 30)] +
+                        [rand.randint(-32768, 32767)
+                         for j in range(NB_VALUES)]])
+
+    conn, child_conn = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=servers, args=(child_conn,))
+    child.daemon = True
+    child.start()
+    ports = conn.recv()
+
+    print('%d samples, %d values per sample' % (nb_samples, NB_VALUES))
+    print('%-13s %6s %8s %10s %12s %9s' % ('backend', 'batch', 'inflight',
+                                          'samples/s', 'CPU us/sample',
+                                          'received'))
+    for name, buffer_type, settings in BACKENDS:
+        elapsed, cpu = measure(buffer_type, settings, ports[buffer_type],
+                               samples)
+        # Let the server count samples not acknowledged (MQTT QoS 0)
+        time.sleep(0.2)
+        conn.send(buffer_type)
+        received = conn.recv()
+        print('%-13s %6s %8s %10.0f %12.1f %9d' % (
+              name, settings.get('batchsize', 1), settings.get('inflight', 1),
+              nb_samples / elapsed, cpu / nb_samples * 1e6, received))
+    conn.send(None)
+    child.join()
+
+if __name__ == '__main__':
+    main()
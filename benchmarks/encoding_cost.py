@@ -0,0 +1,99 @@
+# This script measures the cost of rendering RFM2Pi-like samples with each
+# encoder of oemgatewayencoder, per sample, in requests of one sample and in
+# bulk requests. As a reference, it also measures the rendering of a GET
+# request by string concatenation, as the emoncms buffer used to do.
+#
+# Usage:
+#
+#   python benchmarks/encoding_cost.py [nb_samples]
+#
+# Settings are applied once, before encoding, as in the buffers.
+
+import sys
+import os
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oemgatewayencoder as oge
+
+##############
+# Parameters #
+##############
+
+# Number of samples encoded
+NB_SAMPLES = 100000
+
+# Number of values per sample
+NB_VALUES = 8
+
+# Samples per bulk request
+BATCHSIZE = 50
+
+# Buffer settings
+SETTINGS = {'path': '/emoncms', 'apikey': 'x' * 32,
+            'measurement': 'oemgateway'}
+
+########
+# Code #
+########
+
+def concatenate(samples, maxbytes=0):
+    """Render a GET request by string concatenation."""
+
+    t, data = samples[0]
+    data_string = ''
+    data_string += '&time=' + str(t)
+    data_string += '&node=' + str(data[0])
+    data_string += '&json={'
+    for i, val in enumerate(data[1:]):
+        data_string += str(i+1) + ':' + str(val)
+        data_string += ','
+    data_string = data_string[0:-1]+'}'
+    url_string = SETTINGS['path'] + '/input/post.json?apikey=' + \
+                 SETTINGS['apikey'] + data_string
+    return 1, url_string, None
+
+def measure(encode, samples, batchsize):
+    """Encode all samples, return time and bytes per sample."""
+
+    size = 0
+    start = time.time()
+    i = 0
+    while i < len(samples):
+        count, url, body = encode(samples[i:i + batchsize])
+        size += len(url or '') + len(body or '')
+        i += count
+    return (time.time() - start) / len(samples), float(size) / len(samples)
+
+def main():
+
+    nb_samples = int(sys.argv[1]) if len(sys.argv) > 1 else NB_SAMPLES
+
+    rand = random.Random(0)
+    t = time.time()
+    samples = []
+    for i in range(nb_samples):
+        t += 0.01
+        samples.append([round(t, 2), [rand.randint(1, 30)] +
+                        [rand.randint(-32768, 32767)
+                         for j in range(NB_VALUES)]])
+
+    print('%d samples, %d values per sample' % (nb_samples, NB_VALUES))
+    print('%-8s %6s %14s %14s' % ('encoding', 'batch', 'us/sample',
+                                  'bytes/sample'))
+    cost, size = measure(concatenate, samples, 1)
+    print('%-8s %6d %14.2f %14.0f' % ('concat', 1, cost * 1e6, size))
+    for name in sorted(oge.ENCODERS):
+        encoder = oge.ENCODERS[name]()
+        encoder.set(**SETTINGS)
+        for batchsize in (1, BATCHSIZE):
+            if batchsize > 1 and not encoder.bulk:
+                continue
+            cost, size = measure(encoder.encode, samples, batchsize)
+            print('%-8s %6d %14.2f %14.0f' % (name, batchsize, cost * 1e6,
+                                              size))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+# This script measures the gateway end-to-end performance, without any
+# hardware, by replaying a stream of frames into a listener and sending the
+# data to a local stub emoncms server.
+#
+# Usage:
+#
+#   python benchmarks/gateway_replay.py [options]
+#
+# See python benchmarks/gateway_replay.py --help for the options.
+#
+# Sources:
+# - rfm2pi: OemGatewayRFM2PiListener, frames are written to a pseudo-terminal
+#   standing for the serial port
+# - socket: OemGatewaySocketListener, frames are sent through a TCP connection
+# - repeater: OemGatewayRFM2PiListenerRepeater, frames are written to the
+#   pseudo-terminal, while frames to repeat are sent through a TCP connection
+#
+# Frames are either generated (with a fixed seed, for reproducibility) or read
+# from a capture file (one frame per line, as output on the serial port or
+# sent to the socket). A capture should only contain valid frames, as
+# latency is computed by matching frames and posted samples in order.
+#
+# The stub server and the frame feeder run in a child process, so that the
+# CPU time and memory measured are those of the gateway only.
+#
+# Reported:
+# - frames/s: frames received by the server divided by the time between the
+#   first frame sent and the last sample received
+# - p50, p99: latency between a frame being sent and the server receiving it
+# - CPU: gateway process CPU time (user + system), and ratio to elapsed time
+# - RSS: gateway process max resident set size
+
+import sys
+import os
+import imp
+import time
+import json
+import random
+import socket
+import signal
+import logging
+import argparse
+import resource
+import threading
+import urlparse
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import oemgatewayinterface as ogi
+
+##############
+# Parameters #
+##############
+
+# Defaults, can be overridden by command line arguments
+NB_FRAMES = 2000
+NB_NODES = 10
+NB_VALUES = 4
+SEED = 0
+
+# Time in seconds to wait for the last samples
+TIMEOUT = 60
+
+########
+# Code #
+########
+
+class StubEmoncms(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """emoncms stub, recording the arrival time of each sample."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubEmoncmsHandler)
+        self.lock = threading.Lock()
+        self.arrivals = []
+        self.complete = threading.Event()
+        self.expected = 0
+
+    def record(self, nb_samples):
+        now = time.time()
+        with self.lock:
+            self.arrivals.extend([now] * nb_samples)
+            if len(self.arrivals) >= self.expected:
+                self.complete.set()
+
+class StubEmoncmsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # Send response in one write (avoids delayed ACK on keep-alive)
+    wbufsize = -1
+
+    def do_GET(self):
+        # input/post.json: one sample per request
+        self.server.record(1)
+        self._reply()
+
+    def do_POST(self):
+        # input/bulk.json: data=[[t,node,val1,...],...]
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        data = urlparse.parse_qs(body)['data'][0]
+        self.server.record(len(json.loads(data)))
+        self._reply()
+
+    def _reply(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, format, *args):
+        pass
+
+class ReplayInterface(ogi.OemGatewayInterface):
+    """Interface with fixed settings."""
+
+    def __init__(self, settings):
+        super(ReplayInterface, self).__init__()
+        self.settings = settings
+
+    def check_settings(self):
+        return False
+
+    def next_run(self):
+        return time.time() + 60
+
+def generate_frames(source, nb_frames, nb_nodes, nb_values, seed):
+    """Return a list of synthetic frames."""
+
+    rand = random.Random(seed)
+    frames = []
+    for i in range(nb_frames):
+        node = 10 + i % nb_nodes
+        if source == 'socket':
+            values = [str(rand.randint(-32768, 32767))
+                      for j in range(nb_values)]
+        else:
+            values = [str(rand.randint(0, 255)) for j in range(2 * nb_values)]
+        frames.append(' '.join([str(node)] + values))
+    return frames
+
+def driver(conn, master, port_nb, frames, repeat_frames, rate):
+    """Run in child process: stub server and frame feeder."""
+
+    server = StubEmoncms()
+    server.expected = len(frames)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    # Tell the gateway the server port, and wait for the gateway to be ready
+    conn.send(server.server_address[1])
+    conn.recv()
+
+    # Read and count repeated bytes from pseudo-terminal
+    # (frames are repeated without line terminator)
+    repeated = [0]
+    if repeat_frames:
+        def read_repeated():
+            while True:
+                repeated[0] += len(os.read(master, 4096))
+        reader = threading.Thread(target=read_repeated)
+        reader.daemon = True
+        reader.start()
+
+    if master is None:
+        sock = socket.create_connection(('127.0.0.1', port_nb))
+        write = sock.sendall
+    else:
+        write = lambda data: os.write(master, data)
+        if repeat_frames:
+            sock = socket.create_connection(('127.0.0.1', port_nb))
+
+    # Send frames
+    sent = []
+    start = time.time()
+    for i, f in enumerate(frames):
+        if rate:
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sent.append(time.time())
+        write(f + '\r\n')
+        if repeat_frames:
+            sock.sendall(repeat_frames[i % len(repeat_frames)] + '\r\n')
+
+    server.complete.wait(TIMEOUT)
+    with server.lock:
+        arrivals = list(server.arrivals)
+    conn.send((sent, arrivals, repeated[0]))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.), len(values) - 1)]
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Gateway replay benchmark')
+    parser.add_argument('--source', choices=['rfm2pi', 'socket', 'repeater'],
+                        default='rfm2pi')
+    parser.add_argument('--capture', help='file of recorded frames')
+    parser.add_argument('--frames', type=int, default=NB_FRAMES,
+                        help='number of synthetic frames')
+    parser.add_argument('--nodes', type=int, default=NB_NODES,
+                        help='number of nodes in synthetic frames')
+    parser.add_argument('--values', type=int, default=NB_VALUES,
+                        help='number of values in synthetic frames')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='frames per second, 0 for as fast as possible')
+    parser.add_argument('--batchsize', default='1',
+                        help='buffer batchsize runtime setting')
+    parser.add_argument('--loglevel', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.loglevel)
+
+    if args.capture:
+        with open(args.capture) as f:
+            frames = [line.rstrip('\r\n') for line in f if line.strip()]
+    else:
+        frames = generate_frames(args.source, args.frames, args.nodes,
+                                 args.values, args.seed)
+    repeat_frames = None
+    if args.source == 'repeater':
+        repeat_frames = ['%d,%d,s' % (i, i) for i in range(10)]
+
+    # Serial port
+    if args.source in ('rfm2pi', 'repeater'):
+        master, slave = os.openpty()
+        com_port = os.ttyname(slave)
+    else:
+        master = None
+
+    # Socket port
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port_nb = s.getsockname()[1]
+    s.close()
+
+    # Start stub server and feeder
+    conn, child_conn = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=driver, args=(child_conn, master,
+        port_nb, frames, repeat_frames, args.rate))
+    child.daemon = True
+    child.start()
+    server_port = conn.recv()
+
+    # Gateway settings
+    if args.source == 'rfm2pi':
+        listener = {'type': 'OemGatewayRFM2PiListener',
+                    'init_settings': {'com_port': com_port}}
+    elif args.source == 'repeater':
+        listener = {'type': 'OemGatewayRFM2PiListenerRepeater',
+                    'init_settings': {'com_port': com_port,
+                                      'port_nb': str(port_nb)}}
+    else:
+        listener = {'type': 'OemGatewaySocketListener',
+                    'init_settings': {'port_nb': str(port_nb)}}
+    # No radio settings: the commands would delay repeated frames
+    if args.source == 'socket':
+        listener['runtime_settings'] = {}
+    else:
+        listener['runtime_settings'] = {'sendtimeinterval': '0'}
+    settings = {
+        'gateway': {'loglevel': args.loglevel},
+        'listeners': {'replay': listener},
+        'buffers': {'stub': {
+            'type': 'OemGatewayEmoncmsBuffer',
+            'init_settings': {'queue_size': str(len(frames))},
+            'runtime_settings': {'protocol': 'http://',
+                                 'domain': '127.0.0.1:%d' % server_port,
+                                 'path': '/emoncms', 'apikey': 'x',
+                                 'active': 'True',
+                                 'batchsize': args.batchsize,
+                                 'maxbytes': '65536',
+                                 'retrymin': '0.01', 'retrymax': '0.1'}}}}
+
+    og = imp.load_source('oemgateway', os.path.join(ROOT, 'oemgateway'))
+    gateway = og.OemGateway(ReplayInterface(settings))
+
+    # Stop gateway when feeder is done
+    results = []
+    def wait_results():
+        results.append(conn.recv())
+        os.kill(os.getpid(), signal.SIGINT)
+    waiter = threading.Thread(target=wait_results)
+    waiter.daemon = True
+    waiter.start()
+
+    # Go
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    conn.send('go')
+    gateway.run()
+    elapsed = time.time() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    gateway.close()
+
+    sent, arrivals, repeated = results[0]
+    latencies = [(a - s) * 1000 for s, a in zip(sent, arrivals)]
+    cpu = (usage_end.ru_utime - usage_start.ru_utime +
+           usage_end.ru_stime - usage_start.ru_stime)
+
+    print('source: %s, frames: %d, rate: %s, batchsize: %s, seed: %d' %
+          (args.source, len(frames), args.rate or 'max', args.batchsize,
+           args.seed))
+    print('received: %d/%d' % (len(arrivals), len(frames)))
+    if repeat_frames:
+        print('repeated: %d/%d bytes' % (repeated, sum(
+            len(repeat_frames[i % len(repeat_frames)])
+            for i in range(len(frames)))))
+    if arrivals:
+        print('frames/s: %.0f' % (len(arrivals) / (arrivals[-1] - sent[0])))
+        print('latency p50: %.1f ms, p99: %.1f ms' %
+              (percentile(latencies, 50), percentile(latencies, 99)))
+    print('CPU: %.2f s (%.0f %%)' % (cpu, cpu / elapsed * 100))
+    print('max RSS: %.1f MB' % (usage_end.ru_maxrss / 1024.))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# This script compares the memory used by the in-memory buffer queues:
+# OemGatewayQueue (a list per sample) and OemGatewayArrayQueue (typed arrays),
+# holding a backlog of RFM2Pi-like samples in several buffers, as when the
+# network is down. It also measures the time to fill and drain the queues.
+#
+# Usage:
+#
+#   python benchmarks/queue_memory.py [nb_samples]
+#
+# Each measure is done in a new process, so that memory freed by a previous
+# measure is not reused. Memory is the increase of the process max resident
+# set size, divided by the number of samples and buffers.
+
+import sys
+import os
+import random
+import resource
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oemgatewayqueue as ogq
+
+##############
+# Parameters #
+##############
+
+# Number of samples in backlog
+NB_SAMPLES = 200000
+
+# Number of values per sample
+NB_VALUES = 8
+
+# Numbers of buffers receiving the same samples
+NB_BUFFERS = (1, 3)
+
+# Samples sent per request when draining
+BATCHSIZE = 50
+
+########
+# Code #
+########
+
+QUEUES = [('list', ogq.OemGatewayQueue), ('array', ogq.OemGatewayArrayQueue)]
+
+def measure(queue_class, nb_samples, nb_buffers, conn):
+    """Run in child process: fill and drain queues, send results."""
+
+    rand = random.Random(0)
+    queues = [queue_class(nb_samples) for i in range(nb_buffers)]
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # As in the gateway, buffers share the frame, and each sample gets its
+    # own timestamp
+    start = time.time()
+    t = time.time()
+    for i in range(nb_samples):
+        data = [rand.randint(1, 30)] + [rand.randint(-32768, 32767)
+                                        for j in range(NB_VALUES)]
+        t += 0.01
+        for q in queues:
+            q.append([round(t, 2), data])
+    fill = time.time() - start
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    for q in queues:
+        while len(q):
+            q.peek(BATCHSIZE)
+            q.pop(BATCHSIZE)
+    drain = time.time() - start
+
+    conn.send(((rss_end - rss_start) * 1024., fill, drain))
+
+def main():
+
+    nb_samples = int(sys.argv[1]) if len(sys.argv) > 1 else NB_SAMPLES
+
+    print('%d samples, %d values per sample' % (nb_samples, NB_VALUES))
+    print('%-6s %8s %12s %10s %10s' % ('queue', 'buffers', 'bytes/sample',
+                                       'fill (s)', 'drain (s)'))
+    for nb_buffers in NB_BUFFERS:
+        for name, queue_class in QUEUES:
+            conn, child_conn = multiprocessing.Pipe()
+            child = multiprocessing.Process(target=measure, args=(
+                queue_class, nb_samples, nb_buffers, child_conn))
+            child.start()
+            memory, fill, drain = conn.recv()
+            child.join()
+            print('%-6s %8d %12.0f %10.2f %10.2f' % (name, nb_buffers,
+                  memory / nb_samples / nb_buffers, fill, drain))
+
+if __name__ == '__main__':
+    main()
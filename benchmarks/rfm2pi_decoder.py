@@ -0,0 +1,165 @@
+# This script compares the speed of OemGatewayRFM2PiListener frame decoder
+# with the original implementation (before struct-based decoding), with and
+# without node schemas. It also checks they all give the same results.
+#
+# Usage:
+#
+#   python benchmarks/rfm2pi_decoder.py [capture_file]
+#
+# capture_file is an optional file containing recorded RFM2Pi frames, one
+# per line, as output on the serial port (e.g. '10 23 1 164 6'). If none is
+# given, frames are generated randomly (with a fixed seed, for
+# reproducibility).
+
+import sys
+import os
+import random
+import logging
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oemgatewaylistener as ogl
+
+##############
+# Parameters #
+##############
+
+# Number of synthetic frames
+NB_FRAMES = 1000
+
+# Number of values per synthetic frame
+NB_VALUES = 8
+
+# Number of repetitions, the best one is kept
+REPEAT = 30
+
+# Logging level, as in production
+LOGLEVEL = logging.WARNING
+
+########
+# Code #
+########
+
+class BenchListener(ogl.OemGatewayRFM2PiListener):
+    """RFM2Pi listener without serial port."""
+
+    def __init__(self):
+        ogl.OemGatewayListener.__init__(self)
+        self._settings = {'nodes': {}}
+        self._schemas = {}
+        # Commands are not written anywhere
+        self._commands = ogl.OemGatewaySerialCommandQueue(lambda command: None)
+
+    def _process_frame_legacy(self, f):
+        """Original decoder, for reference."""
+
+        self._log.info("Serial RX: " + f)
+        received = f.strip().split(' ')
+        if ((received[0] == '>') or (received[0] == '->')):
+            return
+        elif ((not (len(received) & 1)) or (len(received) < 3)):
+            self._log.warning("Misformed RX frame: " + str(received))
+        else:
+            try:
+                received = [int(val) for val in received]
+            except Exception:
+                self._log.warning("Misformed RX frame: " + str(received))
+            else:
+                node = received[0]
+                values = []
+                for i in range(1, len(received),2):
+                    value = received[i] + 256 * received[i+1]
+                    if value >= 32768:
+                        value -= 65536
+                    values.append(value)
+                self._log.debug("Node: " + str(node))
+                self._log.debug("Values: " + str(values))
+                values.insert(0, node)
+                return values
+
+# Recorded RFM2Pi output, with startup banner and command acknowledgements,
+# always included in the checks
+CAPTURE = [
+    '[RF12demo.10] _ i15 g210 @ 433 MHz',
+    '> 15i',
+    '> 4b',
+    '> 210g',
+    '10 23 1 164 6 0 0 94 9',
+    '-> 8 b',
+    '> 1v',
+    '5 255 255 1 128 0 128',
+    '10 23 1 164',
+    '',
+    ' 11 4 0 ',
+]
+
+def synthetic_frames():
+    rand = random.Random(0)
+    return [' '.join([str(rand.randint(1, 30))] +
+                     [str(rand.randint(0, 255)) for i in range(2 * NB_VALUES)])
+            for j in range(NB_FRAMES)]
+
+def main():
+
+    logging.basicConfig(level=LOGLEVEL)
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            frames = [line.rstrip('\r\n') for line in f if line.strip()]
+    else:
+        frames = synthetic_frames()
+
+    listener = BenchListener()
+
+    # Listener with an explicit int16 schema for each node, which should
+    # decode exactly as the default decoder
+    schema_listener = BenchListener()
+    lengths = {}
+    for f in frames + CAPTURE:
+        received = f.split()
+        if not received or not received[0].isdigit():
+            continue
+        lengths.setdefault(received[0], set()).add(len(received) - 1)
+    schema_listener.set(nodes=dict(
+        (node, {'format': 'h' * (l.pop() // 2)})
+        for node, l in lengths.iteritems() if len(l) == 1))
+
+    # Check decoders give the same results, without logging misformed frames
+    # and invalid schemas
+    logging.disable(logging.ERROR)
+    for f in frames + CAPTURE:
+        legacy = listener._process_frame_legacy(f)
+        assert listener._process_frame(f) == legacy, f
+        assert schema_listener._process_frame(f) == legacy, f
+
+    # Check schemas with non-numeric types are skipped
+    invalid_listener = BenchListener()
+    invalid_listener.set(nodes={'1': {'format': '4s'},
+                                '2': {'format': 'h?', 'scales': ['0.1']},
+                                '3': {'format': 'xx'},
+                                '4': {'format': 'hh'}})
+    assert invalid_listener._schemas.keys() == [4]
+    logging.disable(logging.NOTSET)
+
+    decoders = [('legacy', listener._process_frame_legacy),
+                ('struct', listener._process_frame),
+                ('schema', schema_listener._process_frame)]
+
+    # Decoders are timed in turn in each repetition, so that a slowdown of
+    # the machine during the benchmark does not favour one of them
+    best = dict((name, float('inf')) for name, decoder in decoders)
+    for i in range(REPEAT):
+        for name, decoder in decoders:
+            def run():
+                for f in frames:
+                    decoder(f)
+            best[name] = min(best[name], timeit.timeit(run, number=1))
+
+    for name, decoder in decoders:
+        print('%-8s %8.2f us/frame  %10.0f frames/s  x%.2f' %
+              (name, best[name] / len(frames) * 1e6, len(frames) / best[name],
+               best['legacy'] / best[name]))
+
+if __name__ == '__main__':
+    main()
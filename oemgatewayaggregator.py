@@ -0,0 +1,142 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+"""class OemGatewayAggregator
+
+Folds samples into fixed time windows, one record per node and window.
+
+Windows are aligned on multiples of their duration (e.g. every minute, at
+0 second). The record of a window is timestamped with the end of the window.
+
+Each value is reduced with one of the following reducers:
+'mean', 'min', 'max', 'last', 'sum' (e.g. for pulse counts).
+
+Only the current window is kept for each node, so memory does not depend on
+the number of samples.
+
+"""
+class OemGatewayAggregator(object):
+
+    REDUCERS = ('mean', 'min', 'max', 'last', 'sum')
+
+    def __init__(self, window, reducers='mean', nodes=None):
+        """Initialize aggregator
+
+        window (string): window duration in seconds
+        reducers (string or list): reducer, or reducers by value index. The
+        last reducer applies to the remaining values.
+        nodes (dict): reducers for specific nodes, {node: reducers}
+
+        Raise ValueError if a setting is invalid.
+
+        """
+
+        self._window = float(window)
+        if self._window <= 0:
+            raise ValueError("Invalid window: %s" % window)
+        self._reducers = _reducers(reducers)
+        self._node_reducers = {}
+        for node, r in (nodes or {}).iteritems():
+            self._node_reducers[int(node)] = _reducers(r)
+
+        # Current window by node: {node: [start, count, reducers, accs]}
+        self._states = {}
+
+    def add(self, t, data):
+        """Add a sample, and return the records of the windows it closes.
+
+        t (float): sample timestamp
+        data (list): node and values: [node, val1, val2, ...]
+
+        Return a list of records: [[timestamp, [node, val1, val2, ...]], ...]
+
+        """
+
+        node = data[0]
+        values = data[1:]
+        start = t - t % self._window
+        records = []
+        state = self._states.get(node)
+        # New window, or number of values changed: close current window
+        if state is not None and (state[0] != start or
+                                  len(state[3]) != len(values)):
+            records.append(self._record(node, state))
+            state = None
+        if state is None:
+            reducers = self._node_reducers.get(int(node), self._reducers)
+            reducers = [reducers[min(i, len(reducers) - 1)]
+                        for i in range(len(values))]
+            self._states[node] = [start, 1, reducers, list(values)]
+            return records
+
+        state[1] += 1
+        accs = state[3]
+        for i, reducer in enumerate(state[2]):
+            value = values[i]
+            if reducer == 'mean' or reducer == 'sum':
+                accs[i] += value
+            elif reducer == 'min':
+                if value < accs[i]:
+                    accs[i] = value
+            elif reducer == 'max':
+                if value > accs[i]:
+                    accs[i] = value
+            else:
+                accs[i] = value
+        return records
+
+    def expire(self, now):
+        """Return the records of the windows ended at time now."""
+
+        records = []
+        for node, state in self._states.items():
+            if state[0] + self._window <= now:
+                records.append(self._record(node, state))
+                del self._states[node]
+        return records
+
+    def flush(self):
+        """Return the records of all current windows, even incomplete."""
+
+        records = [self._record(node, state)
+                   for node, state in self._states.iteritems()]
+        self._states.clear()
+        return records
+
+    def next_expiry(self):
+        """Return the time at which the first window ends, or None."""
+
+        if self._states:
+            return min(state[0] for state in self._states.itervalues()) + \
+                   self._window
+
+    def _record(self, node, state):
+        """Return the record of a window."""
+
+        start, count, reducers, accs = state
+        values = [acc / float(count) if reducer == 'mean' else acc
+                  for reducer, acc in zip(reducers, accs)]
+        return [round(start + self._window, 2), [node] + values]
+
+def _reducers(reducers):
+    """Return a list of reducers from a setting, raise ValueError if invalid.
+
+    reducers (string or list): reducer or list of reducers
+
+    """
+
+    if isinstance(reducers, basestring):
+        reducers = [reducers]
+    reducers = [r.strip() for r in reducers]
+    if not reducers:
+        raise ValueError("No reducer")
+    for r in reducers:
+        if r not in OemGatewayAggregator.REDUCERS:
+            raise ValueError("Unknown reducer: %s" % r)
+    return reducers
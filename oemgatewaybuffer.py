@@ -7,9 +7,20 @@
 
 """
 
-import urllib2, httplib
+import urllib, httplib
+import socket
 import time
+import random
 import logging
+import sqlite3
+import threading
+
+import oemgatewayqueue as ogq
+import oemgatewayhttp as ogh
+import oemgatewaymetrics as ogm
+import oemgatewayaggregator as oga
+import oemgatewayencoder as oge
+import oemgatewaymqtt as ogmq
 
 """class OemGatewayBuffer
 
@@ -21,15 +32,108 @@ destination server.
 """
 class OemGatewayBuffer(object):
 
-    def __init__(self):
-        """Create a server data buffer initialized with server settings."""
+    def __init__(self, queue='memory', queue_file=None, queue_size=1000):
+        """Create a server data buffer initialized with server settings.
+        
+        queue (string): queue backend, 'memory', 'array', 'sqlite' or 
+        'shared'
+        queue_file (string): path to queue file, if queue is 'sqlite'
+        queue_size (string): maximum number of samples in queue
+        
+        """
         
         # Initialize logger
         self._log = logging.getLogger("OemGateway")
         
+        # Buffer name, used in metrics. Set by the gateway.
+        self.name = self.__class__.__name__
+        
         # Initialize variables
-        self._data_buffer = []
+        self._data_buffer = self._open_queue(queue, queue_file, queue_size)
         self._settings = {}
+        self._retry = OemGatewayRetryScheduler()
+        # Aggregator, if samples are aggregated over time windows
+        self._aggregator = None
+        
+        # Initialize sender thread
+        # _lock protects _data_buffer and _aggregator, shared by main thread
+        # and sender thread
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._exit = False
+        self._thread = None
+
+    def start(self):
+        """Start sender thread.
+        
+        The sender thread flushes the buffer in background, so that a slow
+        server does not block the listeners.
+        
+        Call once runtime settings are set.
+        
+        """
+        
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def close(self):
+        """Stop sender thread and close buffer queue."""
+        
+        if self._thread is not None:
+            self._exit = True
+            self._wakeup.set()
+            # Don't wait for a request stuck on a dead server
+            self._thread.join(5)
+            if self._thread.is_alive():
+                self._log.warning("Sender thread still running, exiting anyway")
+        
+        with self._lock:
+            # Keep incomplete windows
+            if self._aggregator is not None:
+                self._append(self._aggregator.flush())
+            self._data_buffer.close()
+
+    def _run(self):
+        """Send data until asked to stop."""
+        
+        while not self._exit:
+            try:
+                self._run_once()
+            except Exception:
+                # Don't let an unexpected error stop the thread for good:
+                # log it, and retry later
+                import traceback
+                self._log.error("Buffer %s, unexpected error: %s", self.name,
+                                traceback.format_exc())
+                self._retry.failure()
+                self._wakeup.wait(max(self._retry.next_retry - time.time(), 0))
+
+    def _run_once(self):
+        """Send data, then wait until data is added or a deadline."""
+        
+        # Clear wakeup flag before flushing, so that no sample
+        # added during the flush goes unnoticed
+        self._wakeup.clear()
+        # Queue records of ended aggregation windows
+        deadlines = []
+        with self._lock:
+            if self._aggregator is not None:
+                self._append(self._aggregator.expire(time.time()))
+                deadlines.append(self._aggregator.next_expiry())
+        if self.flush():
+            return
+        with self._lock:
+            empty = not len(self._data_buffer)
+        if not empty:
+            # Sending failed, retry later
+            deadlines.append(self._retry.next_retry)
+        deadlines = [d for d in deadlines if d is not None]
+        if deadlines:
+            self._wakeup.wait(max(min(deadlines) - time.time(), 0))
+        else:
+            # Sleep until data is added
+            self._wakeup.wait()
         
     def set(self, **kwargs):
         """Update settings.
@@ -40,33 +144,164 @@ class OemGatewayBuffer(object):
         path (string): emoncms path with leading slash (eg: '/emoncms')
         apikey (string): API key with write access
         active (string): whether the data buffer is active (True/False)
+        batchsize (string): max number of samples sent per request (eg: '1')
+        maxbytes (string): max size of a bulk request payload (eg: '8192')
+        connecttimeout (string): connection timeout in seconds (eg: '10')
+        readtimeout (string): response timeout in seconds (eg: '60')
+        retrymin (string): min delay in seconds before retrying (eg: '1')
+        retrymax (string): max delay in seconds before retrying (eg: '300')
+        breakerthreshold (string): number of consecutive failures before 
+        suspending send attempts (eg: '5')
+        aggregatewindow (string): if not 0, duration in seconds of the 
+        windows samples are aggregated over (eg: '60')
+        aggregate (string or list): reducer, or reducers by value index,
+        among mean, min, max, last, sum (eg: 'mean')
+        aggregatenodes (dict): reducers for specific nodes 
+        (eg: {'10': ['mean', 'sum']})
+        encoding (string): request format, among get, post and bulk. Default
+        is get if batchsize is 1, bulk otherwise.
         
         """
 
         for key, value in kwargs.iteritems():
             self._settings[key] = value
+        
+        self._retry.set(self._settings.get('retrymin', 1),
+                        self._settings.get('retrymax', 300),
+                        self._settings.get('breakerthreshold', 5))
+        
+        if set(['aggregatewindow', 'aggregate', 'aggregatenodes']) & \
+           set(kwargs):
+            self._set_aggregator()
+    
+    def _set_aggregator(self):
+        """Replace aggregator according to settings.
+        
+        Records of the current windows are queued.
+        
+        """
+        
+        aggregator = None
+        if float(self._settings.get('aggregatewindow', 0)):
+            try:
+                aggregator = oga.OemGatewayAggregator(
+                    self._settings['aggregatewindow'],
+                    self._settings.get('aggregate', 'mean'),
+                    self._settings.get('aggregatenodes'))
+            except ValueError as e:
+                self._log.error("Invalid aggregation settings, "
+                                "samples are not aggregated: %s", e)
+        with self._lock:
+            if self._aggregator is not None:
+                self._append(self._aggregator.flush())
+            self._aggregator = aggregator
+        # Wake sender thread up to send records and schedule window ends
+        self._wakeup.set()
+
+    def status(self):
+        """Return buffer status, for monitoring.
+
+        Return a dict with keys
+        'queued': number of samples in buffer
+        'dropped': number of samples dropped because the buffer was full
+        'breaker': circuit breaker state ('closed', 'open' or 'half-open')
+        'failures': number of consecutive send failures
+        'next_retry': time of next send attempt after a failure
+
+        """
+
+        with self._lock:
+            queued = len(self._data_buffer)
+            dropped = self._data_buffer.dropped
+        return {'queued': queued,
+                'dropped': dropped,
+                'breaker': self._retry.state,
+                'failures': self._retry.failures,
+                'next_retry': self._retry.next_retry}
 
     def add(self, data):
         """Append data to buffer.
 
         data (list): node and values (eg: '[node,val1,val2,...]')
 
+        """
+        
+        self.add_many([data])
+
+    def add_many(self, data_list, t=None):
+        """Append several sets of data to buffer.
+
+        data_list (list): node and values sets
+        (eg: '[[node,val1,val2,...],[node,val1,val2,...]]')
+        t (float): timestamp, default is now
+
+        All sets of data get the same timestamp. Buffers with a shared queue
+        receiving the same data_list with the same timestamp store it once.
+
         """
        
         if self._settings['active'] == 'False':
             return
         
         # Timestamp = now
-        t = round(time.time(),2)
+        if t is None:
+            t = round(time.time(),2)
         
-        self._log.debug("Server " + 
-                           self._settings['domain'] + self._settings['path'] + 
-                           " -> buffer data: " + str(data) + 
-                           ", timestamp: " + str(t))
+        if self._log.isEnabledFor(logging.DEBUG):
+            for data in data_list:
+                self._log.debug("Server %s%s -> buffer data: %s, timestamp: %s",
+                                self._settings['domain'],
+                                self._settings.get('path', ''), data, t)
         
-        # Append data set [timestamp, [node, val1, val2, val3,...]] 
-        # to _data_buffer
-        self._data_buffer.append([t, data])
+        # Append data sets [timestamp, [node, val1, val2, val3,...]] 
+        # to _data_buffer, or to aggregation windows
+        with self._lock:
+            if self._aggregator is None:
+                self._append([[t, data] for data in data_list])
+            else:
+                for data in data_list:
+                    self._append(self._aggregator.add(t, data))
+        
+        # Wake sender thread up
+        self._wakeup.set()
+    
+    def _append(self, samples):
+        """Append samples to _data_buffer. Call with _lock held.
+        
+        samples (list): [[timestamp, [node, val1, val2, ...]], ...]
+        
+        """
+        
+        self._data_buffer.append_many(samples)
+
+    def _open_queue(self, queue, queue_file, queue_size):
+        """Open queue
+
+        queue (string): queue backend, 'memory', 'array', 'sqlite' or 
+        'shared'
+        queue_file (string): path to queue file, if queue is 'sqlite'
+        queue_size (string): maximum number of samples in queue
+
+        """
+        
+        if queue == 'memory':
+            return ogq.OemGatewayQueue(queue_size)
+        elif queue == 'array':
+            return ogq.OemGatewayArrayQueue(queue_size)
+        elif queue == 'shared':
+            return ogq.shared_log.queue(queue_size)
+        elif queue == 'sqlite':
+            if queue_file is None:
+                raise OemGatewayBufferInitError(
+                    'queue_file must be specified for sqlite queue')
+            try:
+                return ogq.OemGatewaySQLiteQueue(queue_file, queue_size)
+            except sqlite3.Error as e:
+                self._log.error(e)
+                raise OemGatewayBufferInitError(
+                    'Could not open queue file %s' % queue_file)
+        else:
+            raise OemGatewayBufferInitError('Unknown queue type %s' % queue)
 
     def _send_data(self, data, time):
         """Send data to server.
@@ -81,25 +316,93 @@ class OemGatewayBuffer(object):
         """
         pass
 
+    def _send_bulk_data(self, samples):
+        """Send several samples to server in a single request.
+
+        samples (list): samples in the form [[timestamp, [node, val1,...]],...]
+
+        return the number of samples sent, 0 in case of failure. A subclass
+        may send fewer samples than requested (e.g. to limit the payload
+        size), but the samples it sends succeed or fail together.
+        
+        Default implementation sends the oldest sample using _send_data.
+        Override in subclass if the server supports bulk upload.
+
+        """
+        
+        t, data = samples[0]
+        if self._send_data(data, t):
+            return 1
+        return 0
+
+    def _flush_size(self):
+        """Return the max number of samples sent by a flush.
+        
+        Default is batchsize setting. Override in subclass if several
+        requests are sent at once.
+        
+        """
+        
+        return max(int(self._settings.get('batchsize', 1)), 1)
+
     def flush(self):
-        """Send oldest data in buffer, if any."""
+        """Send oldest data in buffer, if any.
+        
+        If batchsize setting is greater than 1, send up to batchsize samples
+        in one request.
+        
+        Return True if data was sent.
+        
+        """
+        
+        # After a failure, wait until next retry is due
+        if not self._retry.allow():
+            return False
+        
+        size = self._flush_size()
+        
+        # Get oldest samples in buffer
+        with self._lock:
+            samples = self._data_buffer.peek(size)
+            dropped = self._data_buffer.dropped
         
-        # Buffer management
         # If data buffer not empty, send a set of values
-        if self._data_buffer != []:
-            time, data = self._data_buffer[0]
-            self._log.debug("Server " + 
-                           self._settings['domain'] + self._settings['path'] + 
-                           " -> send data: " + str(data) + 
-                           ", timestamp: " + str(time))
-            if self._send_data(data, time):
-                # In case of success, delete sample set from buffer
-                del self._data_buffer[0]
-        # If buffer size reaches maximum, trash oldest values
-        # TODO: optionnal write to file instead of losing data
-        size = len(self._data_buffer)
-        if size > 1000:
-            self._data_buffer = self._data_buffer[size - 1000:]
+        if not samples:
+            return False
+        start = time.time()
+        if size > 1:
+            self._log.debug("Server %s%s -> send %d samples",
+                            self._settings['domain'],
+                            self._settings.get('path', ''),
+                            len(samples))
+            sent = self._send_bulk_data(samples)
+        else:
+            t, data = samples[0]
+            self._log.debug("Server %s%s -> send data: %s, timestamp: %s",
+                            self._settings['domain'],
+                            self._settings.get('path', ''),
+                            data, t)
+            sent = 1 if self._send_data(data, t) else 0
+        ogm.metrics.observe('oemgateway_send_duration_seconds', 
+                            time.time() - start, buffer=self.name)
+        
+        # In case of failure, schedule next attempt
+        if not sent:
+            ogm.metrics.inc('oemgateway_send_failures_total', buffer=self.name)
+            self._retry.failure()
+            return False
+        
+        # In case of success, delete sent samples from buffer
+        ogm.metrics.inc('oemgateway_samples_sent_total', sent, 
+                        buffer=self.name)
+        self._retry.success()
+        with self._lock:
+            # Samples dropped because the buffer was full while sending
+            # were the oldest ones, hence the ones that were just sent
+            to_delete = sent - (self._data_buffer.dropped - dropped)
+            if to_delete > 0:
+                self._data_buffer.pop(to_delete)
+        return True
 
 """class OemGatewayEmoncmsBuffer
 
@@ -108,53 +411,449 @@ Stores server parameters and buffers the data between two HTTP requests
 """
 class OemGatewayEmoncmsBuffer(OemGatewayBuffer):
 
+    # Encodings supported by emoncms
+    ENCODINGS = ('get', 'post', 'bulk')
+
+    def __init__(self, **kwargs):
+
+        super(OemGatewayEmoncmsBuffer, self).__init__(**kwargs)
+
+        # Encoder, rendering requests according to settings
+        self._encoder = None
+
+    def set(self, **kwargs):
+        """Update settings, and render request templates."""
+
+        super(OemGatewayEmoncmsBuffer, self).set(**kwargs)
+
+        # Default encoding depends on batchsize
+        encoding = self._settings.get('encoding')
+        if encoding is None:
+            if int(self._settings.get('batchsize', 1)) > 1:
+                encoding = 'bulk'
+            else:
+                encoding = 'get'
+        elif encoding not in self.ENCODINGS:
+            self._log.error("Unknown encoding %s, using bulk", encoding)
+            encoding = 'bulk'
+        encoder = oge.ENCODERS[encoding]()
+        encoder.set(**self._settings)
+        # Sender thread uses the new encoder from next request
+        self._encoder = encoder
+
     def _send_data(self, data, time):
         """Send data to server."""
-        
-        # Prepare data string with the values in data buffer
-        data_string = ''
-        # Timestamp
-        data_string += '&time=' + str(time)
-        # Node ID
-        data_string += '&node=' + str(data[0])
-        # Data
-        data_string += '&json={'
-        for i, val in enumerate(data[1:]):
-            data_string += str(i+1) + ':' + str(val)
-            data_string += ','
-        # Remove trailing comma and close braces
-        data_string = data_string[0:-1]+'}'
-        self._log.debug("Data string: " + data_string)
-        
-        # Prepare URL string of the form
-        # 'http://domain.tld/emoncms/input/post.json?apikey=12345
-        # &node=10&json={1:1806, 2:1664}'
-        url_string = self._settings['protocol'] + self._settings['domain'] + \
-                     self._settings['path'] + '/input/post.json?apikey=' + \
-                     self._settings['apikey'] + data_string
-        self._log.debug("URL string: " + url_string)
 
+        return self._send_bulk_data([[time, data]]) == 1
+
+    def _send_bulk_data(self, samples):
+        """Send samples to server using the encoding setting.
+        
+        With bulk encoding, samples are packed until maxbytes setting is
+        reached.
+        
+        """
+        
+        count, url_string, body = self._encoder.encode(
+            samples, int(self._settings.get('maxbytes', 8192)))
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug("URL string: %s", url_string)
+            if body is not None:
+                self._log.debug("Data string: %s", body)
+        
         # Send data to server
-        self._log.info("Sending to " + 
-                          self._settings['domain'] + self._settings['path'])
+        self._log.info("Sending %d samples to %s%s", count,
+                       self._settings['domain'], self._settings['path'])
+        if self._request(url_string, body, self._encoder.content_type):
+            return count
+        return 0
+
+    def _request(self, url_string, body=None, content_type=None):
+        """Send HTTP request to server.
+        
+        url_string (string): URL path and query string
+        body (string): data to POST, if any (otherwise, GET is used)
+        content_type (string): content type of body
+        
+        The connection to the server is kept open between requests.
+        
+        return True if server answered 'ok'
+        
+        """
+        
+        conn = ogh.get_connection(self._settings['protocol'], 
+                                  self._settings['domain'])
+        
         try:
-            result = urllib2.urlopen(url_string, timeout=60)
-        except urllib2.HTTPError as e:
-            self._log.warning("Couldn't send to server, HTTPError: " + 
-                                 str(e.code))
-        except urllib2.URLError as e:
-            self._log.warning("Couldn't send to server, URLError: " + 
-                                 str(e.reason))
-        except httplib.HTTPException:
-            self._log.warning("Couldn't send to server, HTTPException")
+            if body is None:
+                status, headers, result = conn.fetch(
+                    'GET', url_string, timeouts=_timeouts(self._settings))
+            else:
+                status, headers, result = conn.fetch(
+                    'POST', url_string, body, {'Content-Type': content_type},
+                    _timeouts(self._settings))
+        except socket.error as e:
+            self._log.warning("Couldn't send to server, socket error: " + 
+                                 str(e))
+        except httplib.HTTPException as e:
+            self._log.warning("Couldn't send to server, HTTPException: " +
+                                 repr(e))
         except Exception:
             import traceback
             self._log.warning("Couldn't send to server, Exception: " + 
                                  traceback.format_exc())
         else:
-            if (result.readline() == 'ok'):
+            if 300 <= status < 400:
+                # Redirects are not followed
+                self._log.error("Couldn't send to server, redirected to %s: "
+                                "check protocol, domain and path settings",
+                                headers.get('location'))
+            elif status != 200:
+                self._log.warning("Couldn't send to server, HTTPError: " + 
+                                     str(status))
+            elif (result.strip() == 'ok'):
                 self._log.debug("Send ok")
                 return True
             else:
                 self._log.warning("Send failure")
+
+"""class OemGatewayInfluxDBBuffer
+
+Sends data to an InfluxDB server (1.x HTTP API), in line protocol.
+
+Samples are sent in batches of up to batchsize samples, and up to inflight
+requests are pipelined on the connection to the server.
+
+"""
+class OemGatewayInfluxDBBuffer(OemGatewayBuffer):
+
+    # HTTP status of points rejected as invalid, which are not retried:
+    # Bad Request, Request Entity Too Large, Unprocessable Entity
+    REJECTED = (400, 413, 422)
+
+    def __init__(self, **kwargs):
+
+        super(OemGatewayInfluxDBBuffer, self).__init__(**kwargs)
+
+        # Encoder and URL, rendered according to settings
+        self._encoder = None
+        self._url = None
+
+    def set(self, **kwargs):
+        """Update settings, and render request templates.
+        
+        protocol (string): 'http://' or 'https://'
+        domain (string): domain name and port (eg: 'localhost:8086')
+        path (string): path to the API, if any (eg: '/influxdb')
+        database (string): database name (eg: 'oemgateway')
+        measurement (string): measurement name (eg: 'oemgateway')
+        username (string): user name, if authentication is enabled
+        password (string): password, if authentication is enabled
+        inflight (string): max number of requests sent at once (eg: '4')
+        
+        See OemGatewayBuffer for other settings.
+        
+        """
+
+        super(OemGatewayInfluxDBBuffer, self).set(**kwargs)
+
+        query = [('db', self._settings.get('database', 'oemgateway')),
+                 ('precision', 'ms')]
+        if self._settings.get('username'):
+            query += [('u', self._settings['username']),
+                      ('p', self._settings.get('password', ''))]
+        encoder = oge.OemGatewayLineProtocolEncoder()
+        encoder.set(**self._settings)
+        # Sender thread uses the new URL and encoder from next request
+        self._url = self._settings.get('path', '') + '/write?' + \
+                    urllib.urlencode(query)
+        self._encoder = encoder
+
+    def _flush_size(self):
+        """Return the max number of samples sent by a flush."""
+
+        return _flush_size(self._settings)
+
+    def _send_data(self, data, time):
+        """Send data to server."""
+
+        return self._send_bulk_data([[time, data]]) == 1
+
+    def _send_bulk_data(self, samples):
+        """Send samples to server, in pipelined requests."""
+
+        batches = _encode_batches(self._encoder, samples, self._settings)
+        url_string = self._url
+        headers = {'Content-Type': self._encoder.content_type}
+
+        conn = ogh.get_connection(self._settings['protocol'],
+                                  self._settings['domain'])
+
+        # Send data to server
+        self._log.info("Sending %d samples in %d requests to %s%s",
+                       sum(count for count, body in batches), len(batches),
+                       self._settings['domain'], self._settings.get('path', ''))
+        try:
+            responses = conn.pipeline([('POST', url_string, body, headers)
+                                       for count, body in batches],
+                                      _timeouts(self._settings))
+        except socket.error as e:
+            self._log.warning("Couldn't send to server, socket error: %s", e)
+            return 0
+        except httplib.HTTPException as e:
+            self._log.warning("Couldn't send to server, HTTPException: %r", e)
+            return 0
+        except Exception:
+            import traceback
+            self._log.warning("Couldn't send to server, Exception: %s",
+                              traceback.format_exc())
+            return 0
+
+        # Samples are sent until the first request failing. Samples rejected
+        # by the server are dropped, as if sent.
+        sent = 0
+        for (status, result), (count, body) in zip(responses, batches):
+            if 300 <= status < 400:
+                # Redirects are not followed
+                self._log.error("Couldn't send to server, redirected (%s): "
+                                "check protocol, domain and path settings",
+                                status)
+                break
+            if status in self.REJECTED:
+                # Retrying would fail the same way
+                self._log.error("Server rejected %d samples (HTTPError %s %s), "
+                                "dropping them", count, status,
+                                result.strip()[:200])
+            elif status != 204:
+                self._log.warning("Couldn't send to server, HTTPError: %s %s",
+                                  status, result.strip())
+                break
+            sent += count
+        return sent
+
+"""class OemGatewayMQTTBuffer
+
+Publishes data to an MQTT broker, in CSV or line protocol.
+
+Each message holds up to batchsize samples, and up to inflight messages are
+published at once, before waiting for their acknowledgements.
+
+"""
+class OemGatewayMQTTBuffer(OemGatewayBuffer):
+
+    # Encodings of the messages
+    ENCODINGS = ('csv', 'line')
+
+    def __init__(self, **kwargs):
+
+        super(OemGatewayMQTTBuffer, self).__init__(**kwargs)
+
+        # Encoder, rendering messages according to settings
+        self._encoder = None
+        self._client = ogmq.OemGatewayMQTTClient()
+
+    def close(self):
+        """Stop sender thread, close buffer queue and disconnect."""
+
+        super(OemGatewayMQTTBuffer, self).close()
+        self._client.close()
+
+    def set(self, **kwargs):
+        """Update settings.
+        
+        domain (string): broker host name and port (eg: 'localhost:1883')
+        topic (string): topic messages are published to (eg: 'oemgateway')
+        qos (string): 0 (at most once) or 1 (at least once)
+        clientid (string): client identifier, generated by broker if empty
+        username (string): user name, if authentication is enabled
+        password (string): password, if authentication is enabled
+        keepalive (string): keep alive interval in seconds (eg: '60')
+        encoding (string): 'csv' or 'line'
+        inflight (string): max number of messages sent at once (eg: '4')
         
+        See OemGatewayBuffer for other settings.
+        
+        """
+
+        super(OemGatewayMQTTBuffer, self).set(**kwargs)
+
+        encoding = self._settings.get('encoding', 'csv')
+        if encoding not in self.ENCODINGS:
+            self._log.error("Unknown encoding %s, using csv", encoding)
+            encoding = 'csv'
+        encoder = oge.ENCODERS[encoding]()
+        encoder.set(**self._settings)
+        self._encoder = encoder
+        self._client.set(self._settings['domain'],
+                         self._settings.get('clientid', ''),
+                         self._settings.get('username'),
+                         self._settings.get('password'),
+                         self._settings.get('keepalive', 60))
+
+    def _flush_size(self):
+        """Return the max number of samples sent by a flush."""
+
+        return _flush_size(self._settings)
+
+    def _send_data(self, data, time):
+        """Send data to broker."""
+
+        return self._send_bulk_data([[time, data]]) == 1
+
+    def _send_bulk_data(self, samples):
+        """Publish samples to broker, several messages at once."""
+
+        batches = _encode_batches(self._encoder, samples, self._settings)
+        qos = 0 if self._settings.get('qos', '1') == '0' else 1
+        self._client.connect_timeout = float(
+            self._settings.get('connecttimeout', 10))
+        self._client.read_timeout = float(self._settings.get('readtimeout', 60))
+
+        # Send data to broker
+        self._log.info("Publishing %d samples in %d messages to %s",
+                       sum(count for count, body in batches), len(batches),
+                       self._settings['domain'])
+        try:
+            published = self._client.publish(
+                self._settings.get('topic', 'oemgateway'),
+                [body for count, body in batches], qos)
+        except socket.error as e:
+            self._log.warning("Couldn't publish to broker, socket error: %s",
+                              e)
+            return 0
+        except ogmq.OemGatewayMQTTError as e:
+            self._log.warning("Couldn't publish to broker: %s", e)
+            return 0
+        except Exception:
+            import traceback
+            self._log.warning("Couldn't publish to broker, Exception: %s",
+                              traceback.format_exc())
+            return 0
+
+        return sum(count for count, body in batches[:published])
+
+def _flush_size(settings):
+    """Return the number of samples in inflight requests of batchsize."""
+
+    return max(int(settings.get('batchsize', 1)), 1) * \
+           max(int(settings.get('inflight', 1)), 1)
+
+def _timeouts(settings):
+    """Return the connection and response timeouts of a buffer."""
+
+    return (float(settings.get('connecttimeout', 10)),
+            float(settings.get('readtimeout', 60)))
+
+def _encode_batches(encoder, samples, settings):
+    """Encode samples in requests.
+
+    encoder (OemGatewayEncoder): encoder
+    samples (list): [[timestamp, [node, val1, val2, ...]], ...]
+    settings (dict): buffer settings batchsize, maxbytes and inflight
+
+    Return a list of up to inflight requests of up to batchsize samples each:
+    [(number of samples, body), ...]
+
+    """
+
+    batchsize = max(int(settings.get('batchsize', 1)), 1)
+    maxbytes = int(settings.get('maxbytes', 65536))
+    inflight = max(int(settings.get('inflight', 1)), 1)
+    batches = []
+    i = 0
+    while i < len(samples) and len(batches) < inflight:
+        count, url, body = encoder.encode(samples[i:i + batchsize], maxbytes)
+        batches.append((count, body))
+        i += count
+    return batches
+
+"""class OemGatewayRetryScheduler
+
+Schedules send attempts after failures, with exponential backoff and a
+circuit breaker.
+
+After each consecutive failure, the delay before next attempt doubles, from
+retrymin up to retrymax, with random jitter so that buffers don't retry all
+at the same time.
+
+The circuit breaker is
+- 'closed' while sending works,
+- 'open' after breakerthreshold consecutive failures: send attempts are 
+skipped until next retry is due,
+- 'half-open' when next retry is due: one attempt is made, and the breaker
+is closed if it succeeds, opened again otherwise.
+
+"""
+class OemGatewayRetryScheduler(object):
+
+    def __init__(self):
+
+        # Initialize logger
+        self._log = logging.getLogger("OemGateway")
+
+        self._retrymin = 1.
+        self._retrymax = 300.
+        self._threshold = 5
+
+        self.state = 'closed'
+        self.failures = 0
+        self.next_retry = 0
+
+    def set(self, retrymin, retrymax, threshold):
+        """Update settings.
+
+        retrymin (string): min delay in seconds before retrying
+        retrymax (string): max delay in seconds before retrying
+        threshold (string): number of consecutive failures opening breaker
+
+        """
+
+        self._retrymin = float(retrymin)
+        self._retrymax = float(retrymax)
+        self._threshold = int(threshold)
+
+    def allow(self):
+        """Return True if a send attempt can be made now."""
+
+        if time.time() < self.next_retry:
+            return False
+        if self.state == 'open':
+            self.state = 'half-open'
+        return True
+
+    def success(self):
+        """Record a successful attempt."""
+
+        if self.state != 'closed':
+            self._log.info("Server reachable again after %d failures",
+                           self.failures)
+        self.state = 'closed'
+        self.failures = 0
+        self.next_retry = 0
+
+    def failure(self):
+        """Record a failed attempt and schedule next one."""
+
+        self.failures += 1
+        # Exponent is capped, so that a long outage can't overflow
+        delay = min(self._retrymin * 2 ** min(self.failures - 1, 30), 
+                    self._retrymax)
+        # Jitter: wait between half and full delay
+        delay *= random.uniform(0.5, 1)
+        self.next_retry = time.time() + delay
+
+        if self.state == 'half-open':
+            self._log.debug("Next attempt in %.1f s", delay)
+            self.state = 'open'
+        elif self.state == 'closed' and self.failures >= self._threshold:
+            self._log.warning("Suspending send attempts after %d failures",
+                              self.failures)
+            self.state = 'open'
+
+"""class OemGatewayBufferInitError
+
+Raise this when init fails.
+
+"""
+class OemGatewayBufferInitError(Exception):
+    pass
@@ -0,0 +1,260 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import urllib
+import time
+
+"""class OemGatewayEncoder
+
+Renders samples into the payload of a request.
+
+The parts of the request that only depend on settings (URL, API key,
+measurement name...) are rendered once, when settings are updated with
+set(). The template of an entry is compiled once per number of values, and
+encode() then only fills in the values of the samples, each payload being
+built with a single join.
+
+This class is meant to be inherited by subclasses specific to a format.
+
+"""
+class OemGatewayEncoder(object):
+
+    # Content type of the body
+    content_type = 'text/plain'
+    # Whether several samples can be encoded in a single payload
+    bulk = True
+    # Size of the payload around the entries
+    overhead = 0
+
+    def __init__(self):
+
+        # Entry templates by number of values, node included
+        self._templates = {}
+        self.set()
+
+    def set(self, **kwargs):
+        """Update settings and render templates.
+
+        **kwargs (dict): buffer settings. Settings not used by the format
+        are ignored.
+
+        Subclasses render their templates in _set().
+
+        """
+
+        self._templates.clear()
+        self._set(**kwargs)
+
+    def _set(self, **kwargs):
+        """Render templates from settings.
+
+        To be implemented in subclass.
+
+        """
+
+        pass
+
+    def encode(self, samples, maxbytes=0):
+        """Render samples.
+
+        samples (list): [[timestamp, [node, val1, val2, ...]], ...]
+        maxbytes (int): if not 0, max size of the payload. At least one
+        sample is encoded, even if its entry is larger.
+
+        Return (count, url, body):
+        count (int): number of samples encoded, oldest first
+        url (string): URL path and query string, None if the format does not
+        define it
+        body (string): data to POST, None for a GET request
+
+        """
+
+        if not self.bulk:
+            samples = samples[:1]
+        templates = self._templates
+        entries = []
+        size = self.overhead
+        for t, data in samples:
+            template = templates.get(len(data))
+            if template is None:
+                template = templates[len(data)] = self._compile(len(data))
+            e = template % self._values(t, data)
+            # Stop before exceeding max payload size
+            size += len(e) + 1
+            if entries and maxbytes and size > maxbytes:
+                break
+            entries.append(e)
+        url, body = self._render(entries)
+        return len(entries), url, body
+
+    def _compile(self, size):
+        """Return the template of an entry, as a format string.
+
+        size (int): number of values, node included
+
+        To be implemented in subclass.
+
+        """
+
+        pass
+
+    def _values(self, t, data):
+        """Return the tuple filling in the template of an entry.
+
+        Default is the timestamp followed by node and values.
+
+        """
+
+        return (t,) + tuple(data)
+
+    def _render(self, entries):
+        """Return (url, body) from the entries of the samples.
+
+        Default implementation returns entries as lines of the body.
+
+        """
+
+        return None, ''.join(entries)
+
+"""class OemGatewayEmoncmsGetEncoder
+
+Emoncms input API, one sample per GET request:
+
+/emoncms/input/post.json?apikey=12345&time=1400000000.5&node=10
+&json={1:1806,2:1664}
+
+"""
+class OemGatewayEmoncmsGetEncoder(OemGatewayEncoder):
+
+    bulk = False
+
+    def _set(self, path='', apikey='', **kwargs):
+
+        # '%' in settings must not be taken for a placeholder
+        self._url = (path + '/input/post.json?apikey=' +
+                     apikey).replace('%', '%%')
+
+    def _compile(self, size):
+
+        return self._url + '&time=%s&node=%s&json={' + \
+            ','.join(['%d:%%s' % i for i in range(1, size)]) + '}'
+
+    def _render(self, entries):
+
+        return entries[0], None
+
+"""class OemGatewayEmoncmsPostEncoder
+
+Emoncms input API, one sample per POST request, with the same fields as the
+GET request in the body.
+
+"""
+class OemGatewayEmoncmsPostEncoder(OemGatewayEncoder):
+
+    content_type = 'application/x-www-form-urlencoded'
+    bulk = False
+
+    def _set(self, path='', apikey='', **kwargs):
+
+        self._url = path + '/input/post.json?apikey=' + apikey
+
+    def _compile(self, size):
+
+        # Same as urlencode: '{', ':', ',' and '}' are quoted
+        return 'time=%s&node=%s&json=' + urllib.quote_plus(
+            '{' + ','.join(['%d:' % i for i in range(1, size)]) + '}',
+            ).replace('%', '%%').replace('%%3A', '%%3A%s')
+
+    def _render(self, entries):
+
+        # Quote '+' of exponents, the only character of numbers that is
+        # not safe in a form
+        return self._url, entries[0].replace('+', '%2B')
+
+"""class OemGatewayEmoncmsBulkEncoder
+
+Emoncms bulk API, several samples per POST request:
+
+data=[[timestamp,node,val1,val2,...],[timestamp,node,val1,...],...]
+
+Timestamps are absolute, and sentat is set to current time so that emoncms
+can correct clock offset between gateway and server.
+
+"""
+class OemGatewayEmoncmsBulkEncoder(OemGatewayEncoder):
+
+    content_type = 'application/x-www-form-urlencoded'
+    overhead = 2
+
+    def _set(self, path='', apikey='', **kwargs):
+
+        self._url = path + '/input/bulk.json?apikey=' + apikey
+
+    def _compile(self, size):
+
+        return '[%d,' + ','.join(['%s'] * size) + ']'
+
+    def _render(self, entries):
+
+        # Values being numbers, quoting brackets, commas and '+' gives the
+        # same body as urlencode, faster
+        data = '[' + ','.join(entries) + ']'
+        data = data.replace('+', '%2B').replace('[', '%5B').replace(
+            ']', '%5D').replace(',', '%2C')
+        return self._url, 'data=%s&sentat=%d' % (data, round(time.time()))
+
+"""class OemGatewayCSVEncoder
+
+One line per sample: timestamp,node,val1,val2,...
+
+"""
+class OemGatewayCSVEncoder(OemGatewayEncoder):
+
+    content_type = 'text/csv'
+
+    def _compile(self, size):
+
+        return ','.join(['%s'] * (size + 1)) + '\n'
+
+"""class OemGatewayLineProtocolEncoder
+
+InfluxDB line protocol, one line per sample, with node as a tag, values as
+fields v1, v2, ... and timestamp in milliseconds:
+
+oemgateway,node=10 v1=1806,v2=1664 1400000000500
+
+Values are written as floats, so that a field keeps the same type whether
+its values are aggregated or not.
+
+"""
+class OemGatewayLineProtocolEncoder(OemGatewayEncoder):
+
+    def _set(self, measurement='oemgateway', **kwargs):
+
+        # Escape measurement name as specified by the line protocol
+        self._measurement = measurement.replace(',', '\\,').replace(
+            ' ', '\\ ').replace('%', '%%')
+
+    def _compile(self, size):
+
+        return self._measurement + ',node=%s ' + \
+            ','.join(['v%d=%%s' % i for i in range(1, size)]) + ' %d\n'
+
+    def _values(self, t, data):
+
+        return tuple(data) + (round(t * 1000),)
+
+# Encoders by encoding setting
+ENCODERS = {
+    'get': OemGatewayEmoncmsGetEncoder,
+    'post': OemGatewayEmoncmsPostEncoder,
+    'bulk': OemGatewayEmoncmsBulkEncoder,
+    'csv': OemGatewayCSVEncoder,
+    'line': OemGatewayLineProtocolEncoder,
+    }
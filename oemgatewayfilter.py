@@ -0,0 +1,125 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import collections
+import time
+import logging
+
+import oemgatewaymetrics as ogm
+
+"""class OemGatewayFrameFilter
+
+Filters frames between listeners and buffers.
+
+Duplicate frames (same node, same values) received within a time window are
+dropped. This happens when several receivers cover the same nodes, or with a
+repeater.
+
+Optionally, frames from a node received less than a minimum interval after
+the previous frame kept for this node are dropped as well.
+
+Frames seen and nodes are indexed in LRU dictionaries, whose entries expire
+after the window or interval, and whose size is bounded.
+
+"""
+class OemGatewayFrameFilter(object):
+
+    def __init__(self):
+
+        # Initialize logger
+        self._log = logging.getLogger("OemGateway")
+
+        # Duplicates window and min interval per node, in seconds
+        self._window = 0
+        self._interval = 0
+        # Max number of entries in each index
+        self._size = 1000
+
+        # Frames seen: {(node, val1, val2, ...): time}, oldest first
+        self._frames = collections.OrderedDict()
+        # Last frame kept by node: {node: time}, oldest first
+        self._nodes = collections.OrderedDict()
+
+    def set(self, dedupwindow=0, nodeinterval=0, dedupsize=1000):
+        """Update settings.
+
+        dedupwindow (string): time in seconds during which duplicate frames
+        are dropped, 0 to keep duplicates
+        nodeinterval (string): min time in seconds between two frames from
+        the same node, 0 for no limit
+        dedupsize (string): max number of frames and nodes remembered
+
+        """
+
+        self._window = float(dedupwindow)
+        self._interval = float(nodeinterval)
+        self._size = int(dedupsize)
+        if not self._window:
+            self._frames.clear()
+        if not self._interval:
+            self._nodes.clear()
+
+    def filter(self, frames):
+        """Return the frames to keep, in order.
+
+        frames (list): frames received, [[NodeID, val1, val2], ...]
+
+        """
+
+        if not (self._window or self._interval):
+            return frames
+
+        now = time.time()
+        if self._window:
+            _expire(self._frames, now - self._window)
+        if self._interval:
+            _expire(self._nodes, now - self._interval)
+
+        kept = []
+        for values in frames:
+            if self._window:
+                key = tuple(values)
+                if key in self._frames:
+                    self._drop('duplicate', values)
+                    continue
+            if self._interval:
+                node = values[0]
+                if node in self._nodes:
+                    self._drop('rate', values)
+                    continue
+                self._nodes[node] = now
+                if len(self._nodes) > self._size:
+                    self._nodes.popitem(last=False)
+            if self._window:
+                self._frames[key] = now
+                if len(self._frames) > self._size:
+                    self._frames.popitem(last=False)
+            kept.append(values)
+        return kept
+
+    def _drop(self, reason, values):
+        """Count a dropped frame.
+
+        reason (string): 'duplicate' or 'rate'
+        values (list): frame
+
+        """
+
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug("Frame dropped (%s): %s", reason, values)
+        ogm.metrics.inc('oemgateway_frames_filtered_total', reason=reason)
+
+def _expire(index, limit):
+    """Remove entries older than limit from an index, oldest first."""
+
+    while index:
+        key, t = next(index.iteritems())
+        if t > limit:
+            break
+        del index[key]
@@ -0,0 +1,283 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import httplib
+import socket
+import select
+import threading
+import logging
+
+"""class OemGatewayHTTPConnection
+
+Persistent connection to an HTTP or HTTPS server.
+
+The connection is kept open between requests (keep-alive), and reopened
+automatically when needed. Requests from several threads are serialized.
+
+A request failing once sent is not sent again, as the server may have
+processed it, except for GET requests on a reused connection. It is up to
+the caller to retry, knowing data may then be received twice.
+
+Several requests can be pipelined: they are all written before reading the
+responses, so that a round trip to the server is not waited for each one.
+
+Connections are shared: use get_connection() to get the connection to a
+server.
+
+"""
+class OemGatewayHTTPConnection(object):
+
+    def __init__(self, protocol, domain):
+        """Initialize connection
+
+        protocol (string): 'http://' or 'https://'
+        domain (string): domain name, optionally with port (eg: 'domain.tld')
+
+        """
+
+        # Initialize logger
+        self._log = logging.getLogger("OemGateway")
+
+        self._protocol = protocol
+        self._domain = domain
+        self._conn = None
+        self._lock = threading.Lock()
+
+        # Default timeouts in seconds
+        self.connect_timeout = 10
+        self.read_timeout = 60
+
+    def request(self, method, url, body=None, headers=None, timeouts=None):
+        """Send request and return response.
+
+        method (string): 'GET' or 'POST'
+        url (string): path and query string (eg: '/emoncms/input/post.json')
+        body (string): request body, if any
+        headers (dict): additional headers
+        timeouts (tuple): connection and response timeouts in seconds, for
+        this request. Default is connect_timeout and read_timeout.
+
+        Return (status, response body).
+
+        Raise socket.error or httplib.HTTPException in case of failure.
+
+        """
+
+        status, response_headers, data = self.fetch(method, url, body, headers,
+                                                    timeouts)
+        return status, data
+
+    def fetch(self, method, url, body=None, headers=None, timeouts=None):
+        """Send request and return response, with its headers.
+
+        Same as request(), but return (status, response headers, response 
+        body), response headers being a dict with lowercase names.
+
+        """
+
+        with self._lock:
+            # If the connection was reused, the server may have closed it
+            # while the request was sent. In this case, retry a GET once on
+            # a new connection. Other requests may have been processed.
+            retry = self._conn is not None and method == 'GET'
+            while True:
+                try:
+                    return self._request(method, url, body, headers,
+                                         timeouts)
+                except socket.timeout:
+                    # Server is unresponsive, don't wait again
+                    self.close()
+                    raise
+                except (socket.error, httplib.HTTPException):
+                    self.close()
+                    if not retry:
+                        raise
+                    self._log.debug("Connection to %s lost, reconnecting",
+                                    self._domain)
+                    retry = False
+
+    def pipeline(self, requests, timeouts=None):
+        """Send several requests at once, and return their responses.
+
+        requests (list): requests, [(method, url, body, headers), ...], with
+        the same arguments as request()
+        timeouts (tuple): connection and response timeouts, as in request()
+
+        Return the responses received, in order: [(status, response body),
+        ...]. If the connection fails, or the server closes it, after some 
+        responses were received, the following requests get no response: 
+        they may or may not have been processed.
+
+        Raise socket.error or httplib.HTTPException if no response was
+        received.
+
+        """
+
+        with self._lock:
+            # Requests are not retried, the server may have processed them
+            responses = []
+            try:
+                self._pipeline(requests, responses, timeouts)
+            except (socket.error, httplib.HTTPException):
+                self.close()
+                if not responses:
+                    raise
+            return responses
+
+    def close(self):
+        """Close connection."""
+
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _open(self, timeouts):
+        """Open connection if needed, and set response timeout.
+
+        timeouts (tuple): connection and response timeouts, None for default
+
+        """
+
+        connect_timeout, read_timeout = timeouts or (self.connect_timeout,
+                                                     self.read_timeout)
+        # Don't send a request on a connection closed by the server
+        if self._conn is not None and self._dropped():
+            self._log.debug("Connection to %s closed by server, reconnecting",
+                            self._domain)
+            self.close()
+        if self._conn is None:
+            if self._protocol == 'https://':
+                conn = httplib.HTTPSConnection(self._domain,
+                                               timeout=connect_timeout)
+            else:
+                conn = httplib.HTTPConnection(self._domain,
+                                              timeout=connect_timeout)
+            self._log.debug("Opening connection to %s%s",
+                            self._protocol, self._domain)
+            conn.connect()
+            self._conn = conn
+        # The connection may be shared by buffers with different timeouts
+        self._conn.sock.settimeout(read_timeout)
+
+    def _dropped(self):
+        """Return True if the idle connection can't be used anymore.
+
+        Nothing is expected from the server between requests: if the socket
+        is readable, the server closed the connection (or sent unexpected
+        data).
+
+        """
+
+        sock = self._conn.sock
+        if sock is None:
+            return True
+        try:
+            readable, writable, errors = select.select([sock], [], [], 0)
+        except (select.error, socket.error):
+            return True
+        return bool(readable)
+
+    def _request(self, method, url, body, headers, timeouts):
+        """Send request on current connection, opening it if needed."""
+
+        self._open(timeouts)
+        self._conn.request(method, url, body, headers or {})
+        response = self._conn.getresponse()
+        # Read the whole response, so that the connection can be reused
+        data = response.read()
+        if response.will_close:
+            self.close()
+        return response.status, dict(response.getheaders()), data
+
+    def _pipeline(self, requests, responses, timeouts):
+        """Send requests on current connection, opening it if needed.
+
+        responses (list): list the responses are appended to
+
+        """
+
+        self._open(timeouts)
+        # httplib can't send a request before the previous response is read:
+        # requests are written directly on the socket
+        data = []
+        for method, url, body, headers in requests:
+            headers = dict(headers or {})
+            headers.setdefault('Host', self._domain)
+            headers['Content-Length'] = len(body or '')
+            data.append('%s %s HTTP/1.1\r\n' % (method, url))
+            data.extend('%s: %s\r\n' % item for item in headers.iteritems())
+            data.append('\r\n')
+            data.append(body or '')
+        self._conn.sock.sendall(''.join(data))
+
+        # Responses are parsed by httplib from a single buffered file, so
+        # that the data of a response read ahead is not lost for the next
+        fp = _ResponseFile(self._conn.sock.makefile('rb'))
+        for method, url, body, headers in requests:
+            response = httplib.HTTPResponse(fp, method=method)
+            response.begin()
+            responses.append((response.status, response.read()))
+            if response.will_close:
+                self.close()
+                return
+
+"""class _ResponseFile
+
+Buffered socket file shared by the pipelined responses, passed to
+httplib.HTTPResponse as a socket. Responses close their file when read,
+which is ignored.
+
+"""
+class _ResponseFile(object):
+
+    def __init__(self, fp):
+
+        self.read = fp.read
+        self.readline = fp.readline
+
+    def makefile(self, mode, bufsize=None):
+
+        return self
+
+    def close(self):
+
+        pass
+
+# Shared connections, by (protocol, domain)
+_connections = {}
+_connections_lock = threading.Lock()
+
+def get_connection(protocol, domain):
+    """Return the shared connection to a server.
+
+    protocol (string): 'http://' or 'https://'
+    domain (string): domain name, optionally with port (eg: 'domain.tld')
+
+    """
+
+    with _connections_lock:
+        try:
+            return _connections[(protocol, domain)]
+        except KeyError:
+            conn = OemGatewayHTTPConnection(protocol, domain)
+            _connections[(protocol, domain)] = conn
+            return conn
+
+def close_connections():
+    """Close all shared connections."""
+
+    with _connections_lock:
+        for conn in _connections.itervalues():
+            # Don't wait for a pending request
+            if conn._lock.acquire(False):
+                try:
+                    conn.close()
+                finally:
+                    conn._lock.release()
+        _connections.clear()
@@ -7,13 +7,22 @@
 
 """
 
-import urllib2
+import httplib
 import time
 import logging
-import csv
+import json
+import hashlib
 import urlparse
+import os
+import errno
+import fcntl
+import struct
+import ctypes
+import threading
 from configobj import ConfigObj
 
+import oemgatewayhttp as ogh
+
 """class OemGatewayInterface
 
 User interface to communicate with the gateway.
@@ -39,7 +48,12 @@ The run() method is supposed to be run regularly by the instanciater, to
 perform regular communication tasks.
 
 The check_settings() method is run regularly as well. It checks the settings 
-and returns True is settings were changed.
+and returns True is settings were changed. When settings change, the settings
+attribute is replaced rather than modified in place, so that the gateway can
+compare new settings to the previous ones.
+
+The get_fds() and next_run() methods tell the gateway when run() and
+check_settings() should be called.
 
 This almost empty class is meant to be inherited by subclasses specific to
 each user interface.
@@ -82,12 +96,53 @@ class OemGatewayInterface(object):
         """
         pass
 
+    def next_run(self):
+        """Return the time at which run() and check_settings() are due.
+        
+        By default, they are called every 0.2 second.
+        
+        To be overridden in child class.
+        
+        """
+        return time.time() + 0.2
+
+    def get_fds(self):
+        """Return the file descriptors to watch, or None.
+        
+        If one of these is readable, run() and check_settings() are called
+        without waiting for next_run().
+        
+        To be overridden in child class.
+        
+        """
+        pass
+
+    def close(self):
+        """Close interface."""
+        pass
+
+"""class OemGatewayEmoncmsInterface
+
+Gets settings from emoncms, and tells emoncms the gateway is running.
+
+Both are done by a background thread, so that a slow or unresponsive emoncms
+server does not block the gateway. Settings are polled with conditional
+requests (ETag and Last-Modified), in case the server supports them. When
+modified, they are published to the main loop, which is woken up through
+the file descriptor returned by get_fds().
+
+"""
 class OemGatewayEmoncmsInterface(OemGatewayInterface):
 
-    def __init__(self, local_url='http://localhost/emoncms'):
+    def __init__(self, local_url='http://localhost/emoncms',
+                 heartbeat_interval=1, poll_interval=1, timeout=10):
         """Initialize emoncms interface
 
         local_url (string): URL to local emoncms server
+        heartbeat_interval (float): period in seconds of "running" status 
+        updates
+        poll_interval (float): period in seconds of settings checks
+        timeout (float): timeout in seconds of requests to emoncms
 
         """
         
@@ -100,42 +155,84 @@ class OemGatewayEmoncmsInterface(OemGatewayInterface):
         self._local_domain = url.netloc
         self._local_path = url.path 
 
-        # Initialize update timestamps
-        self._status_update_timestamp = 0
-        self._settings_update_timestamp = 0
+        # Initialize polling
+        self._heartbeat_interval = float(heartbeat_interval)
+        self._poll_interval = float(poll_interval)
         self._retry_time_interval = 60
 
+        # Connection used by the background thread only, not to wait for
+        # buffers sending data to the same server
+        self._conn = ogh.OemGatewayHTTPConnection(self._local_protocol,
+                                                  self._local_domain)
+        self._conn.connect_timeout = float(timeout)
+        self._conn.read_timeout = float(timeout)
+        
+        # Validators and SHA-1 digest of last settings response
+        self._etag = None
+        self._last_modified = None
+        self._response_digest = None
+
+        # Last settings published by background thread, and latest settings
+        # not yet taken by the main loop
+        self._published = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+        # Pipe used to wake up the main loop when settings are published
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, 
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
         # Check local emoncms URL is valid
         try:
             # Dummy time request
-            result = urllib2.urlopen(self._local_protocol +
-                                     self._local_domain +
-                                     self._local_path +
-                                     "/time/local.json")
-        
+            status, data = self._conn.request('GET', self._local_path + 
+                                              "/time/local.json")
+            if status != 200:
+                raise httplib.HTTPException("HTTP status %d" % status)
         except Exception:
             import traceback
+            self.close()
             raise OemGatewayInterfaceInitError("Failure while connecting to " +
                  local_url + ":\n" + traceback.format_exc())
 
-        # Check settings
+        # Get settings
+        self._poll_settings()
         self.check_settings()
 
-    def run(self):
-        """Run in background. 
+        # Start background thread
+        self._exit = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def next_run(self):
+        """Nothing scheduled: main loop is woken up by get_fds()."""
         
-        Update raspberry_pi running status.
+        return None
+
+    def get_fds(self):
+        """Return the file descriptor signaling new settings."""
         
-        """
+        return [self._wakeup_r]
+
+    def close(self):
+        """Stop background thread."""
         
-        # Update status every second
-        now = time.time()
-        if (now - self._status_update_timestamp > 1):
-            # Update "running" status to inform emoncms the script is running
-            self._gateway_running()
-            # "Thanks for the status update. You've made it crystal clear."
-            self._status_update_timestamp = now
-            
+        if hasattr(self, '_thread'):
+            self._exit.set()
+            self._thread.join(self._conn.read_timeout + 1)
+            if self._thread.is_alive():
+                self._log.warning("Emoncms interface thread still running, "
+                                  "exiting anyway")
+            del self._thread
+        self._conn.close()
+        if self._wakeup_r is not None:
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+
     def check_settings(self):
         """Check settings
         
@@ -143,39 +240,102 @@ class OemGatewayEmoncmsInterface(OemGatewayInterface):
         
         """
         
-        # Check settings only once per second
-        now = time.time()
-        if (now - self._settings_update_timestamp < 1):
-            return
-        # Update timestamp
-        self._settings_update_timestamp = now
+        # Empty wakeup pipe
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        
+        # Take latest settings published by the background thread
+        with self._lock:
+            settings, self._snapshot = self._snapshot, None
+        
+        # Return True if settings modified
+        if settings is not None and settings != self.settings:
+            self.settings = settings
+            return True
+
+    def _run(self):
+        """Background thread: update status and poll settings."""
+        
+        next_heartbeat = 0
+        next_poll = time.time() + self._poll_interval
+        while not self._exit.is_set():
+            now = time.time()
+            if now >= next_heartbeat:
+                self._gateway_running()
+                next_heartbeat = now + self._heartbeat_interval
+            if now >= next_poll:
+                if self._poll_settings():
+                    next_poll = now + self._poll_interval
+                else:
+                    next_poll = now + self._retry_time_interval
+            self._exit.wait(max(min(next_heartbeat, next_poll) - time.time(),
+                                0))
+
+    def _poll_settings(self):
+        """Get settings from emoncms and publish them if modified.
+        
+        Return False in case of failure.
+        
+        """
         
         # Get settings using emoncms API
+        headers = {}
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
         try:
-            result = urllib2.urlopen(self._local_protocol +
-                                     self._local_domain +
-                                     self._local_path +
-                                     "/raspberrypi/get.json")
-            result = result.readline()
+            status, response_headers, result = self._conn.fetch('GET', 
+                self._local_path + "/raspberrypi/get.json", headers=headers)
+            # Not modified
+            if status == 304:
+                return True
+            if status != 200:
+                raise httplib.HTTPException("HTTP status %d" % status)
+            # Response unchanged since last successful poll
+            digest = hashlib.sha1(result).digest()
+            if digest == self._response_digest:
+                return True
             # result is of the form
             # {"userid":"1","sgroup":"210",...,"remoteprotocol":"http:\\/\\/"}
-            result_array = result[1:-1].split(',')
-            # result is now of the form
-            # ['"userid":"1"',..., '"remoteprotocol":"http:\\/\\/"']
             emoncms_s = {}
-            # For each setting, separate key and value
-            for s in result_array:
-                # We can't just use split(':') as there can be ":" inside 
-                # a value (eg: "http://")
-                s_split = csv.reader([s], delimiter=':').next() 
-                emoncms_s[s_split[0]] = s_split[1].replace("\\","")
+            for key, value in json.loads(result).iteritems():
+                emoncms_s[str(key)] = _setting_string(value)
+            settings = self._format_settings(emoncms_s)
 
         except Exception:
             import traceback
             self._log.warning("Couldn't get settings, Exception: " + 
                 traceback.format_exc())
-            self._settings_update_timestamp = now + self._retry_time_interval
-            return
+            return False
+        
+        self._etag = response_headers.get('etag')
+        self._last_modified = response_headers.get('last-modified')
+        self._response_digest = digest
+        
+        # Publish settings if modified
+        if settings != self._published:
+            self._published = settings
+            with self._lock:
+                self._snapshot = settings
+            try:
+                os.write(self._wakeup_w, 'x')
+            except OSError as e:
+                # Pipe full: main loop already has to wake up
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+        return True
+
+    def _format_settings(self, emoncms_s):
+        """Return gateway settings from emoncms settings.
+        
+        emoncms_s (dict): settings returned by emoncms
+        
+        """
         
         settings = {}
         
@@ -217,25 +377,39 @@ class OemGatewayEmoncmsInterface(OemGatewayInterface):
             'apikey': emoncms_s['remoteapikey'],
             'active': emoncms_s['remotesend']}
 
-        # Return True if settings modified
-        if settings != self.settings:
-            self.settings = settings
-            return True
+        return settings
 
     def _gateway_running(self):
         """Update "script running" status."""
         
         try:
-            result = urllib2.urlopen(self._local_protocol +
-                                     self._local_domain +
-                                     self._local_path +
-                                     "/raspberrypi/setrunning.json") 
+            status, data = self._conn.request('GET', self._local_path +
+                                              "/raspberrypi/setrunning.json")
+            if status != 200:
+                raise httplib.HTTPException("HTTP status %d" % status)
         except Exception:
             import traceback
             self._log.warning(
                 "Couldn't update \"running\" status, Exception: " + 
                 traceback.format_exc())
 
+def _setting_string(value):
+    """Return a setting decoded from JSON as a string, as in config files."""
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if value is None:
+        return ''
+    return str(value)
+
+"""class OemGatewayFileInterface
+
+Reads settings from a config file.
+
+The file is only read again when it is modified. Modifications are detected
+with an OemGatewayFileWatcher.
+
+"""
 class OemGatewayFileInterface(OemGatewayInterface):
 
     def __init__(self, filename):
@@ -243,19 +417,36 @@ class OemGatewayFileInterface(OemGatewayInterface):
         # Initialization
         super(OemGatewayFileInterface, self).__init__()
 
-        # Initialize update timestamp
-        self._settings_update_timestamp = 0
-        self._retry_time_interval = 60
+        # Watch file before reading it, not to miss a modification
+        self._filename = filename
+        self._watcher = OemGatewayFileWatcher(filename)
 
         # Initialize attribute settings as a ConfigObj instance
         try:
             self.settings = ConfigObj(filename, file_error=True)
         except IOError as e:
+            self._watcher.close()
             raise OemGatewayInterfaceInitError(e)
         except SyntaxError as e:
+            self._watcher.close()
             raise OemGatewayInterfaceInitError( \
                 'Error parsing config file \"%s\": ' % filename + str(e))
 
+    def next_run(self):
+        """Return the time at which settings check is due."""
+        
+        return self._watcher.next_check()
+
+    def get_fds(self):
+        """Return the file descriptors to watch, or None."""
+        
+        return self._watcher.get_fds()
+
+    def close(self):
+        """Stop watching config file."""
+        
+        self._watcher.close()
+
     def check_settings(self):
         """Check settings
         
@@ -263,37 +454,191 @@ class OemGatewayFileInterface(OemGatewayInterface):
         
         """
         
-        # Check settings only once per second
-        now = time.time()
-        if (now - self._settings_update_timestamp < 1):
+        # Read file only if it was modified
+        if not self._watcher.changed():
             return
-        # Update timestamp
-        self._settings_update_timestamp = now
         
-        # Backup settings
-        settings = dict(self.settings)
-        
-        # Get settings from file
+        # Get settings from file. If it can't be read, keep current 
+        # settings until the file is modified again.
         try:
-            self.settings.reload()
+            settings = ConfigObj(self._filename, file_error=True)
         except IOError as e:
-            self._log.warning('Could not get settings: ' + str(e))
-            self._settings_update_timestamp = now + self._retry_time_interval
+            self._log.warning('Could not get settings: %s', e)
             return
         except SyntaxError as e:
-            self._log.warning('Could not get settings: ' + 
-                              'Error parsing config file: ' + str(e))
-            self._settings_update_timestamp = now + self._retry_time_interval
+            self._log.warning('Could not get settings: '
+                              'Error parsing config file: %s', e)
             return
         except Exception:
             import traceback
             self._log.warning("Couldn't get settings, Exception: " + 
                 traceback.format_exc())
-            self._settings_update_timestamp = now + self._retry_time_interval
             return
         
-        if self.settings != settings:
+        if settings != self.settings:
+            self._log.info("Settings file modified")
+            self.settings = settings
+            return True
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000
+
+# struct inotify_event header: wd, mask, cookie, len
+_inotify_event = struct.Struct('iIII')
+
+"""class OemGatewayFileWatcher
+
+Detects modifications of a file.
+
+Where available (Linux), inotify is used: the directory containing the file
+is watched, so that files replaced by editors (written to a temporary file,
+then renamed) are detected as well. The inotify file descriptor is given
+by get_fds(), so that the caller can wait for a modification.
+
+Otherwise, the file modification time, size and inode are checked every
+second.
+
+"""
+class OemGatewayFileWatcher(object):
+
+    # Period of stat checks, in seconds
+    STAT_INTERVAL = 1
+
+    def __init__(self, filename):
+        """Start watching
+
+        filename (string): path to file
+
+        """
+
+        # Initialize logger
+        self._log = logging.getLogger("OemGateway")
+
+        # Follow symlinks, to watch the directory the file actually is in
+        self._filename = os.path.realpath(filename)
+        self._fd = None
+
+        # Stat fallback
+        self._stat = self._get_stat()
+        self._stat_timestamp = time.time()
+
+        try:
+            self._fd = self._inotify_watch()
+        except (OSError, AttributeError) as e:
+            self._log.debug("inotify not available (%s), "
+                            "checking %s every %s s", e, filename,
+                            self.STAT_INTERVAL)
+
+    def _inotify_watch(self):
+        """Return an inotify file descriptor watching the file directory.
+
+        Raise OSError, or AttributeError if inotify is not supported.
+
+        """
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+               IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, os.path.dirname(self._filename),
+                                  mask) < 0:
+            e = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(e, os.strerror(e))
+        return fd
+
+    def _get_stat(self):
+        """Return file (mtime, size, inode), or None if it can't be read."""
+
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def get_fds(self):
+        """Return inotify file descriptor in a list, or None."""
+
+        if self._fd is not None:
+            return [self._fd]
+
+    def next_check(self):
+        """Return the time at which changed() should be called, or None.
+
+        None means the caller should wait for get_fds() to be readable.
+
+        """
+
+        if self._fd is None:
+            return self._stat_timestamp + self.STAT_INTERVAL
+
+    def changed(self):
+        """Return True if the file may have been modified since last call."""
+
+        if self._fd is not None:
+            return self._read_events()
+
+        now = time.time()
+        if now - self._stat_timestamp < self.STAT_INTERVAL:
+            return False
+        self._stat_timestamp = now
+        stat = self._get_stat()
+        if stat != self._stat:
+            self._stat = stat
             return True
+        return False
+
+    def _read_events(self):
+        """Read pending inotify events.
+
+        Return True if one of them concerns the file.
+
+        """
+
+        name = os.path.basename(self._filename)
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = \
+                    _inotify_event.unpack_from(data, offset)
+                offset += _inotify_event.size
+                if mask & IN_Q_OVERFLOW or \
+                   data[offset:offset + length].rstrip('\0') == name:
+                    changed = True
+                if mask & IN_IGNORED:
+                    # Directory removed or unmounted: fall back to stat
+                    self._log.warning("Can't watch %s anymore, "
+                                      "checking every %s s", self._filename,
+                                      self.STAT_INTERVAL)
+                    self.close()
+                    return True
+                offset += length
+
+    def close(self):
+        """Stop watching."""
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
 
 """class OemGatewayInterfaceInitError
 
@@ -11,6 +11,10 @@ import serial
 import time, datetime
 import logging
 import socket, select
+import struct
+import errno
+
+import oemgatewaymetrics as ogm
 
 """class OemGatewayListener
 
@@ -27,18 +31,73 @@ class OemGatewayListener(object):
         # Initialize logger
         self._log = logging.getLogger("OemGateway")
         
+        # Listener name, used in metrics. Set by the gateway.
+        self.name = self.__class__.__name__
+        
+        # Minimum time in seconds between two "Serial RX" log lines.
+        # 0 to log every frame. Set by the gateway.
+        self.rx_log_interval = 0
+        self._rx_log_next = 0
+        self._rx_log_skipped = 0
+        
     def close(self):
         """Close socket."""
         pass
 
     def read(self):
-        """Read data from socket and process if complete line received.
+        """Read data from socket and process all complete lines received.
 
-        Return data as a list: [NodeID, val1, val2]
+        Return a list of frames: [[NodeID, val1, val2], ...]
         
+        For compatibility, a listener may also return a single frame
+        [NodeID, val1, val2] per call, or None if no frame was received.
+
         """
         pass
 
+    def frames(self):
+        """Return the frames received since last call.
+
+        Return a list of frames: [[NodeID, val1, val2], ...]
+
+        This is the method used by the gateway to get the data. The default
+        implementation calls read(). If read() returns a single frame rather
+        than a list of frames, it is called until it returns None, so that 
+        subclasses returning one frame per call keep working.
+
+        """
+
+        batch = self.read()
+        if batch is None:
+            return []
+        
+        # Single frame: [NodeID, val1, val2]
+        if isinstance(batch, list) and batch and \
+           not isinstance(batch[0], list):
+            batch = [batch]
+            values = self.read()
+            while values is not None:
+                batch.append(values)
+                values = self.read()
+        
+        return batch
+
+    def _process_frames(self, lines):
+        """Process frames of data
+
+        lines (list): frames as strings
+
+        Return a list of the valid frames: [[NodeID, val1, val2], ...]
+
+        """
+
+        frames = []
+        for f in lines:
+            values = self._process_frame(f)
+            if values is not None:
+                frames.append(values)
+        return frames
+
     def _process_frame(self, f):
         """Process a frame of data
 
@@ -54,7 +113,7 @@ class OemGatewayListener(object):
         """
 
         # Log data
-        self._log.info("Serial RX: " + f)
+        self._log_rx(f)
         
         # Get an array out of the space separated string
         received = f.strip().split(' ')
@@ -62,19 +121,56 @@ class OemGatewayListener(object):
         # Discard if frame not of the form [node, val1, ...]
         # with number of elements at least 2
         if (len(received) < 2):
-            self._log.warning("Misformed RX frame: " + str(received))
+            self._malformed("Misformed RX frame: %s", received)
         
         # Else, process frame
         else:
             try:
                 received = [float(val) for val in received]
             except Exception:
-                self._log.warning("Misformed RX frame: " + str(received))
+                self._malformed("Misformed RX frame: %s", received)
             else:
-                self._log.debug("Node: " + str(received[0]))
-                self._log.debug("Values: " + str(received[1:]))
+                if self._log.isEnabledFor(logging.DEBUG):
+                    self._log.debug("Node: %s", received[0])
+                    self._log.debug("Values: %s", received[1:])
                 return received
     
+    def _log_rx(self, f):
+        """Log a received frame.
+        
+        f (string): frame
+        
+        If rx_log_interval is set, at most one frame is logged per interval,
+        along with the number of frames not logged since the previous one.
+        
+        """
+        
+        if not self.rx_log_interval:
+            self._log.info("Serial RX: %s", f)
+            return
+        
+        now = time.time()
+        if now < self._rx_log_next:
+            self._rx_log_skipped += 1
+            return
+        if self._rx_log_skipped:
+            self._log.info("Serial RX: %s (%d frames not logged)", f,
+                           self._rx_log_skipped)
+        else:
+            self._log.info("Serial RX: %s", f)
+        self._rx_log_next = now + self.rx_log_interval
+        self._rx_log_skipped = 0
+    
+    def _malformed(self, msg, *args):
+        """Log and count a misformed frame.
+        
+        msg, args: log message and arguments
+        
+        """
+        
+        self._log.warning(msg, *args)
+        ogm.metrics.inc('oemgateway_frames_malformed_total', listener=self.name)
+
     def set(self, **kwargs):
         """Set configuration parameters.
 
@@ -93,6 +189,27 @@ class OemGatewayListener(object):
         """
         pass
 
+    def get_fds(self):
+        """Return the file descriptors to watch for incoming data.
+
+        Return a list of file descriptors or objects with a fileno() method.
+        The main loop wakes up as soon as one of them is ready to read.
+        
+        Return None if the listener can't be watched and must be polled
+        regularly (default). Override in subclass.
+
+        """
+        return None
+
+    def next_run(self):
+        """Return the time at which run() needs to be called next.
+
+        Return a timestamp, or None if run() has nothing scheduled (default).
+        Override in subclass if run() performs periodic actions.
+
+        """
+        return None
+
     def _open_serial_port(self, com_port):
         """Open serial port
 
@@ -111,10 +228,15 @@ class OemGatewayListener(object):
         else:
             return s
     
-    def _open_socket(self, port_nb):
+    def _open_socket(self, port_nb, backlog=5, rx_buffer_size=4096):
         """Open a socket
 
         port_nb (string): port number on which to open the socket
+        backlog (string): max number of pending connections
+        rx_buffer_size (string): max size of a client's incomplete frame
+
+        Clients may keep their connection open and send several frames.
+        Each client has its own RX buffer.
 
         """
 
@@ -122,14 +244,115 @@ class OemGatewayListener(object):
         
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind(('', int(port_nb)))
-            s.listen(1)
+            s.listen(int(backlog))
+            s.setblocking(0)
         except socket.error as e:
             self._log.error(e)
             raise OemGatewayListenerInitError('Could not open port %s' %
                                             port_nb)
-        else:
-            return s
+        
+        # Initialize client connections: {socket: RX buffer}
+        self._clients = {}
+        self._rx_buffer_size = int(rx_buffer_size)
+        # Clients whose current frame is discarded, being too long
+        self._discarding = set()
+        
+        return s
+
+    def _close_socket(self):
+        """Close socket and client connections."""
+        
+        for conn in self._clients:
+            conn.close()
+        self._clients = {}
+        self._discarding = set()
+        if self._socket is not None:
+           self._log.debug('Closing socket')
+           self._socket.close()
+
+    def _socket_fds(self):
+        """Return socket and client connections."""
+        
+        return [self._socket] + self._clients.keys()
+
+    def _read_socket(self):
+        """Accept connections and read data from all clients.
+
+        Return the list of complete frames received, without CR, LF.
+
+        """
+
+        frames = []
+        
+        # Check if data received
+        ready_to_read, ready_to_write, in_error = \
+            select.select(self._socket_fds(), [], [], 0)
+
+        for s in ready_to_read:
+
+            # New connection(s)
+            if s is self._socket:
+                while True:
+                    try:
+                        conn, addr = self._socket.accept()
+                    except socket.error as e:
+                        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            self._log.warning('Socket error: %s', e)
+                        break
+                    self._log.debug('Connection from %s:%s', *addr)
+                    conn.setblocking(0)
+                    self._clients[conn] = ''
+                continue
+
+            # Data from a client: read until no more data available
+            rx_buf = self._clients[s]
+            closed = False
+            while True:
+                try:
+                    chunk = s.recv(4096)
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self._log.warning('Socket error: %s', e)
+                        closed = True
+                    break
+                if not chunk:
+                    closed = True
+                    break
+                data = rx_buf + chunk
+                
+                # Frame too long: skip data up to the end of the frame, so 
+                # that its tail is not taken for a new frame
+                if s in self._discarding:
+                    end = data.find('\r\n')
+                    if end < 0:
+                        # Keep a CR that may be followed by LF in next chunk
+                        rx_buf = data[-1:] if data.endswith('\r') else ''
+                        continue
+                    self._discarding.remove(s)
+                    data = data[end + 2:]
+                
+                # Extract complete frames, keep the rest in client RX buffer
+                lines = data.split('\r\n')
+                frames.extend(lines[:-1])
+                rx_buf = lines[-1]
+                if len(rx_buf) > self._rx_buffer_size:
+                    self._log.warning('Client RX buffer full, discarding frame')
+                    self._discarding.add(s)
+                    rx_buf = ''
+            
+            # Connection closed by client, discard incomplete frame
+            if closed:
+                if rx_buf and s not in self._discarding:
+                    self._log.warning('Incomplete frame discarded: %s', rx_buf)
+                self._discarding.discard(s)
+                s.close()
+                del self._clients[s]
+            else:
+                self._clients[s] = rx_buf
+
+        return frames
 
 """class OemGatewaySerialListener
 
@@ -162,28 +385,27 @@ class OemGatewaySerialListener(OemGatewayListener):
             self._log.debug("Closing serial port.")
             self._ser.close()
 
+    def get_fds(self):
+        """Return the file descriptors to watch for incoming data."""
+        
+        return [self._ser]
+
     def read(self):
-        """Read data from serial port and process if complete line received.
+        """Read data from serial port and process all complete lines received.
 
-        Return data as a list: [NodeID, val1, val2]
+        Return a list of frames: [[NodeID, val1, val2], ...]
         
         """
         
-        # Read serial RX
-        self._rx_buf = self._rx_buf + self._ser.readline()
+        # Read all data available on serial RX
+        self._rx_buf = self._rx_buf + self._ser.read(self._ser.inWaiting())
         
-        # If line incomplete, exit
-        if '\r\n' not in self._rx_buf:
-            return
+        # Split complete lines, keep incomplete line in buffer
+        lines = self._rx_buf.split('\r\n')
+        self._rx_buf = lines.pop()
 
-        # Remove CR,LF
-        f = self._rx_buf[:-2]
-
-        # Reset buffer
-        self._rx_buf = ''
-
-        # Process data frame
-        return self._process_frame(f)
+        # Process data frames
+        return self._process_frames(lines)
 
 """class OemGatewayRFM2PiListener
 
@@ -192,6 +414,15 @@ Monitors the serial port for data from RFM2Pi
 """
 class OemGatewayRFM2PiListener(OemGatewaySerialListener):
 
+    # Structs used to decode payloads, by number of values
+    _int16_structs = {}
+
+    # struct format codes allowed in node schemas
+    SCHEMA_CODES = 'bBhHiIlLqQfd'
+
+    # Time in seconds to wait after a radio setting command
+    SETTING_INTERVAL = 1
+
     def __init__(self, com_port):
         """Initialize listener
 
@@ -204,10 +435,16 @@ class OemGatewayRFM2PiListener(OemGatewaySerialListener):
 
         # Initialize settings
         self._settings = {'baseid': '', 'frequency': '', 'sgroup': '', 
-            'sendtimeinterval': ''}
+            'sendtimeinterval': '', 'commandack': 'False', 'nodes': {}}
+        
+        # Initialize node schemas: {node: (Struct, scales)}
+        self._schemas = {}
         
         # Initialize time updata timestamp
         self._time_update_timestamp = 0
+        
+        # Commands to the RFM2Pi, written by run()
+        self._commands = OemGatewaySerialCommandQueue(self._ser.write)
 
     def _process_frame(self, f):
         """Process a frame of data
@@ -216,52 +453,127 @@ class OemGatewayRFM2PiListener(OemGatewaySerialListener):
 
         This function recombines the integers and checks their validity.
         
+        By default, values are little-endian signed 16-bit ints. If a 
+        schema is defined for the node, it is used instead.
+        
         Return data as a list: [NodeID, val1, val2]
 
         """
         
         # Log data
-        self._log.info("Serial RX: " + f)
+        self._log_rx(f)
         
         # Get an array out of the space separated string
-        received = f.strip().split(' ')
+        received = f.split()
         
         # If information message, discard
-        if ((received[0] == '>') or (received[0] == '->')):
+        if received and ((received[0] == '>') or (received[0] == '->')):
+            # Command acknowledgement
+            if received[0] == '>':
+                self._commands.acknowledge(f)
             return
 
         # Else, discard if frame not of the form 
-        # [node val1_lsb val1_msb val2_lsb val2_msb ...]
-        # with number of elements odd and at least 3
-        elif ((not (len(received) & 1)) or (len(received) < 3)):
-            self._log.warning("Misformed RX frame: " + str(received))
+        # [node byte1 byte2 ...]
+        # with number of elements at least 2
+        elif (len(received) < 2):
+            self._malformed("Misformed RX frame: %s", received)
+            return
         
         # Else, process frame
+        try:
+            # Only integers are expected, bytes for the payload
+            node = int(received[0])
+            payload = bytearray(map(int, received[1:]))
+        except ValueError:
+            self._malformed("Misformed RX frame: %s", received)
+            return
+        
+        schema = self._schemas.get(node)
+        
+        # Default: recombine transmitted chars into signed ints
+        # Payload must be of the form [val1_lsb val1_msb val2_lsb val2_msb ...]
+        if schema is None:
+            if len(payload) & 1:
+                self._malformed("Misformed RX frame: %s", received)
+                return
+            decoder = self._int16_struct(len(payload) // 2)
+            scales = None
+        # Node schema
         else:
-            try:
-                # Only integers are expected
-                received = [int(val) for val in received]
-            except Exception:
-                self._log.warning("Misformed RX frame: " + str(received))
-            else:
-                # Get node ID
-                node = received[0]
-                
-                # Recombine transmitted chars into signed int
-                values = []
-                for i in range(1, len(received),2):
-                    value = received[i] + 256 * received[i+1]
-                    if value >= 32768:
-                        value -= 65536
-                    values.append(value)
+            decoder, scales = schema
+            if len(payload) != decoder.size:
+                self._malformed("RX frame does not match node %s format: %s",
+                                node, received)
+                return
+
+        # Decode and insert node ID before data
+        values = [node]
+        values.extend(decoder.unpack_from(payload))
+        if scales is not None:
+            values[1:] = [v * k for v, k in zip(values[1:], scales)]
                 
-                self._log.debug("Node: " + str(node))
-                self._log.debug("Values: " + str(values))
-    
-                # Insert node ID before data
-                values.insert(0, node)
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug("Node: %s", node)
+            self._log.debug("Values: %s", values[1:])
+
+        return values
+
+    def _compile_schemas(self, nodes):
+        """Compile node schemas.
 
-                return values
+        nodes (dict): schemas by node ID. Example:
+        {'10': {'format': '<hhI', 'scales': ['0.1', '0.1', '1']}}
+        
+        format is a struct module format string, with numeric types only
+        (bBhHiIlLqQfd). If no byte order is specified, little-endian is 
+        assumed. scales are optional factors applied to the decoded values.
+        
+        Return a dict {node: (Struct, scales)}. Invalid schemas are skipped.
+
+        """
+        
+        schemas = {}
+        for node, schema in nodes.iteritems():
+            try:
+                fmt = schema['format']
+                if fmt[:1] not in '@=<>!':
+                    fmt = '<' + fmt
+                # Only numbers can be scaled and buffered
+                codes = [c for c in fmt[1:]
+                         if not (c.isdigit() or c.isspace())]
+                if not codes or any(c not in self.SCHEMA_CODES for c in codes):
+                    raise ValueError('format must contain only numeric '
+                                     'types %s' % self.SCHEMA_CODES)
+                decoder = struct.Struct(fmt)
+                nb_values = len(decoder.unpack_from(bytearray(decoder.size)))
+                scales = schema.get('scales')
+                if scales is None:
+                    scales = []
+                elif isinstance(scales, basestring):
+                    scales = [scales]
+                scales = [float(k) for k in scales]
+                if len(scales) > nb_values:
+                    raise ValueError('more scales than values')
+                # Values with no scale are not scaled
+                scales += [1.0] * (nb_values - len(scales))
+                # Keep integers when scale is 1
+                scales = [1 if k == 1 else k for k in scales]
+                if scales == [1] * nb_values:
+                    scales = None
+                schemas[int(node)] = (decoder, scales)
+            except (KeyError, TypeError, ValueError, struct.error) as e:
+                self._log.error("Invalid schema for node %s: %s", node, e)
+        return schemas
+
+    @classmethod
+    def _int16_struct(cls, n):
+        """Return a Struct unpacking n little-endian signed 16-bit ints."""
+        
+        try:
+            return cls._int16_structs[n]
+        except KeyError:
+            return cls._int16_structs.setdefault(n, struct.Struct('<%dh' % n))
 
     def set(self, **kwargs):
         """Send configuration parameters to the RFM2Pi through COM port.
@@ -270,6 +582,10 @@ class OemGatewayRFM2PiListener(OemGatewaySerialListener):
         'baseid', 'frequency', 'sgroup'. Example: 
         {'baseid': '15', 'frequency': '4', 'sgroup': '210'}
         
+        Radio settings are queued, and sent by run(), one per second. If
+        'commandack' is 'True', each command waits for the RFM2Pi 
+        acknowledgement of the previous one instead.
+        
         """
         
         for key, value in kwargs.iteritems():
@@ -277,7 +593,7 @@ class OemGatewayRFM2PiListener(OemGatewaySerialListener):
             if key in ['baseid', 'frequency', 'sgroup']:
                 if value != self._settings[key]:
                     self._settings[key] = value
-                    self._log.info("Setting RFM2Pi | %s: %s" % (key, value))
+                    self._log.info("Setting RFM2Pi | %s: %s", key, value)
                     string = value
                     if key == 'baseid':
                         string += 'i'
@@ -285,13 +601,24 @@ class OemGatewayRFM2PiListener(OemGatewaySerialListener):
                         string += 'b'
                     elif key == 'sgroup':
                         string += 'g'
-                    self._ser.write(string)
-                    # Wait a sec between two settings
-                    time.sleep(1)
+                    # Replace pending command for the same setting, if any
+                    self._commands.put(string, key=key, 
+                                       interval=self.SETTING_INTERVAL)
             elif key == 'sendtimeinterval':
                 if value != self._settings[key]:
                     self._log.info("Setting send time interval to %s", value)
                     self._settings[key] = value
+            elif key == 'commandack':
+                if value != self._settings[key]:
+                    self._log.info("Setting command acknowledgement to %s",
+                                   value)
+                    self._settings[key] = value
+                    self._commands.ack = (value == 'True')
+            elif key == 'nodes':
+                if value != self._settings[key]:
+                    self._log.info("Setting node schemas")
+                    self._settings[key] = value
+                    self._schemas = self._compile_schemas(value)
 
     def run(self):
         """Actions that need to be done on a regular basis. 
@@ -308,7 +635,23 @@ class OemGatewayRFM2PiListener(OemGatewaySerialListener):
             if (now - self._time_update_timestamp > interval):
                 self._send_time()
                 self._time_update_timestamp = now
+
+        # Send commands that are due
+        self._commands.run()
     
+    def next_run(self):
+        """Return the time at which next command or time broadcast is due,
+        if any."""
+        
+        deadlines = []
+        if self._commands.next_run() is not None:
+            deadlines.append(self._commands.next_run())
+        interval = int(self._settings['sendtimeinterval'])
+        if (interval):
+            deadlines.append(self._time_update_timestamp + interval)
+        if deadlines:
+            return min(deadlines)
+
     def _send_time(self):
         """Send time over radio link to synchronize emonGLCD.
 
@@ -322,9 +665,11 @@ class OemGatewayRFM2PiListener(OemGatewaySerialListener):
 
         now = datetime.datetime.now()
 
-        self._log.debug("Broadcasting time: %d:%d" % (now.hour, now.minute))
+        self._log.debug("Broadcasting time: %d:%d", now.hour, now.minute)
 
-        self._ser.write("00,%02d,%02d,00,s" % (now.hour, now.minute))
+        # Only the latest time is worth sending
+        self._commands.put("00,%02d,%02d,00,s" % (now.hour, now.minute),
+                           key='time')
 
 """class OemGatewaySocketListener
 
@@ -333,10 +678,12 @@ Monitors a socket for data, typically from ethernet link
 """
 class OemGatewaySocketListener(OemGatewayListener):
 
-    def __init__(self, port_nb):
+    def __init__(self, port_nb, backlog=5, rx_buffer_size=4096):
         """Initialize listener
 
         port_nb (string): port number on which to open the socket
+        backlog (string): max number of pending connections
+        rx_buffer_size (string): max size of a client's incomplete frame
 
         """
  
@@ -344,48 +691,27 @@ class OemGatewaySocketListener(OemGatewayListener):
         super(OemGatewaySocketListener, self).__init__()
 
         # Open socket
-        self._socket = self._open_socket(port_nb)
-
-        # Initialize RX buffer for socket
-        self._sock_rx_buf = ''
+        self._socket = self._open_socket(port_nb, backlog, rx_buffer_size)
 
     def close(self):
         """Close socket."""
         
         # Close socket
-        if self._socket is not None:
-           self._log.debug('Closing socket')
-           self._socket.close()
+        self._close_socket()
+
+    def get_fds(self):
+        """Return the file descriptors to watch for incoming data."""
+        
+        return self._socket_fds()
 
     def read(self):
-        """Read data from socket and process if complete line received.
+        """Read data from socket and process all complete lines received.
 
-        Return data as a list: [NodeID, val1, val2]
+        Return a list of frames: [[NodeID, val1, val2], ...]
         
         """
         
-        # Check if data received
-        ready_to_read, ready_to_write, in_error = \
-            select.select([self._socket], [], [], 0)
-
-        # If data received, add it to socket RX buffer
-        if self._socket in ready_to_read:
-
-            # Accept connection
-            conn, addr = self._socket.accept()
-            
-            # Read data
-            self._sock_rx_buf = self._sock_rx_buf + conn.recv(1024)
-            
-            # Close connection
-            conn.close()
-
-        # If there is at least one complete frame in the buffer
-        if '\r\n' in self._sock_rx_buf:
-            
-            # Process and return first frame in buffer:
-            f, self._sock_rx_buf = self._sock_rx_buf.split('\r\n', 1)
-            return self._process_frame(f)
+        return self._process_frames(self._read_socket())
 
 """class OemGatewayRFM2PiListenerRepeater
 
@@ -395,11 +721,13 @@ and repeats on RF link the frames received through a socket
 """
 class OemGatewayRFM2PiListenerRepeater(OemGatewayRFM2PiListener):
 
-    def __init__(self, com_port, port_nb):
+    def __init__(self, com_port, port_nb, backlog=5, rx_buffer_size=4096):
         """Initialize listener
 
         com_port (string): path to COM port
         port_nb (string): port number on which to open the socket
+        backlog (string): max number of pending connections
+        rx_buffer_size (string): max size of a client's incomplete frame
 
         """
         
@@ -407,40 +735,137 @@ class OemGatewayRFM2PiListenerRepeater(OemGatewayRFM2PiListener):
         super(OemGatewayRFM2PiListenerRepeater, self).__init__(com_port)
 
         # Open socket
-        self._socket = self._open_socket(port_nb)
+        self._socket = self._open_socket(port_nb, backlog, rx_buffer_size)
+
+    def close(self):
+        """Close serial port and socket."""
         
-        # Initialize RX buffer for socket
-        self._sock_rx_buf = ''
+        super(OemGatewayRFM2PiListenerRepeater, self).close()
+        self._close_socket()
+
+    def get_fds(self):
+        """Return the file descriptors to watch for incoming data."""
+        
+        return super(OemGatewayRFM2PiListenerRepeater, self).get_fds() + \
+               self._socket_fds()
 
     def run(self):
         """Monitor socket and repeat data if complete frame received."""
 
-        # Execute run() method from parent
+        # Queue all complete frames received on socket
+        for f in self._read_socket():
+            self._log.info("Sending frame: %s", f)
+            self._commands.put(f)
+
+        # Execute run() method from parent, sending the frames
         super(OemGatewayRFM2PiListenerRepeater, self).run()
-                        
-        # Check if data received on socket
-        ready_to_read, ready_to_write, in_error = \
-        select.select([self._socket], [], [], 0)
 
-        # If data received, add it to socket RX buffer
-        if self._socket in ready_to_read:
+"""class OemGatewaySerialCommandQueue
 
-            # Accept connection
-            conn, addr = self._socket.accept()
-                                                                                                                        
-            # Read data
-            self._sock_rx_buf = self._sock_rx_buf + conn.recv(1024)
-            
-            # Close connection
-            conn.close()
+Commands waiting to be written to a serial port.
 
-        # If there is at least one complete frame in the buffer
-        if '\r\n' in self._sock_rx_buf:
-            
-            # Send first frame in buffer:
-            f, self._sock_rx_buf = self._sock_rx_buf.split('\r\n', 1)
-            self._log.info("Sending frame: %s", f)
-            self._ser.write(f)
+Commands are written by run(), when due, so that the caller is never blocked.
+Each command may require some time to be processed by the device before the
+next one is written.
+
+Optionally (ack attribute), each command waits for the device to acknowledge
+the previous one, by calling acknowledge(), or for ACK_TIMEOUT seconds.
+
+If MAXSIZE commands are pending, new commands are dropped.
+
+"""
+class OemGatewaySerialCommandQueue(object):
+
+    # Time in seconds to wait for an acknowledgement
+    ACK_TIMEOUT = 2
+
+    # Max number of pending commands
+    MAXSIZE = 1000
+
+    def __init__(self, write):
+        """Initialize queue
+
+        write (function): function writing a string to the serial port
+
+        """
+
+        # Initialize logger
+        self._log = logging.getLogger("OemGateway")
+
+        self._write = write
+        self.ack = False
+        # Pending commands: [(command, key, interval), ...]
+        self._commands = []
+        # Time at which next command can be written
+        self._next_timestamp = 0
+        # Command waiting for acknowledgement, and deadline
+        self._unacked = None
+        self._ack_deadline = 0
+
+    def __len__(self):
+        return len(self._commands)
+
+    def put(self, command, key=None, interval=0):
+        """Queue a command.
+
+        command (string): command to write
+        key (string): if not None, pending command with the same key is
+        replaced by this one
+        interval (float): time in seconds to wait after writing the command,
+        when not waiting for acknowledgements
+
+        """
+
+        if key is not None:
+            for i, c in enumerate(self._commands):
+                if c[1] == key:
+                    self._commands[i] = (command, key, interval)
+                    return
+        if len(self._commands) >= self.MAXSIZE:
+            self._log.warning("Command queue full, dropping command: %s",
+                              command)
+            return
+        self._commands.append((command, key, interval))
+
+    def acknowledge(self, line):
+        """Signal a command was acknowledged.
+
+        line (string): acknowledgement received
+
+        """
+
+        if self._unacked is not None:
+            self._log.debug("Command %s acknowledged: %s", self._unacked,
+                            line)
+            self._unacked = None
+
+    def run(self):
+        """Write commands that are due."""
+
+        now = time.time()
+        if self._unacked is not None:
+            if now < self._ack_deadline:
+                return
+            self._log.warning("No acknowledgement for command %s",
+                              self._unacked)
+            self._unacked = None
+        while self._commands and now >= self._next_timestamp:
+            command, key, interval = self._commands.pop(0)
+            self._log.debug("Writing command: %s", command)
+            self._write(command)
+            if self.ack:
+                self._unacked = command
+                self._ack_deadline = now + self.ACK_TIMEOUT
+                return
+            self._next_timestamp = now + interval
+
+    def next_run(self):
+        """Return the time at which run() is due, or None."""
+
+        if self._unacked is not None:
+            return self._ack_deadline
+        if self._commands:
+            return self._next_timestamp
 
 """class OemGatewayListenerInitError
 
@@ -0,0 +1,83 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import Queue
+import threading
+import logging
+
+"""class OemGatewayQueueHandler
+
+Log handler passing records to another handler in a background thread.
+
+Records are formatted by the calling thread, so that arguments are rendered
+as they were when the message was logged. Writing them (and rotating files)
+is done by the background thread.
+
+If the queue is full, records are dropped rather than blocking the caller.
+
+"""
+class OemGatewayQueueHandler(logging.Handler):
+
+    def __init__(self, target, maxsize=10000):
+        """Start background thread
+
+        target (logging.Handler): handler actually writing the records
+        maxsize (int): maximum number of records waiting to be written
+
+        """
+
+        logging.Handler.__init__(self)
+        self._target = target
+        self._queue = Queue.Queue(maxsize)
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        """Queue record."""
+
+        try:
+            # Merge message and arguments, and render traceback, so that the
+            # record does not reference mutable or unpicklable objects
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self._dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        """Write queued records, until None is received."""
+
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                self._target.handle(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': '%d log records dropped' % dropped}))
+            self._target.handle(record)
+
+    def close(self):
+        """Write pending records, stop thread and close target handler."""
+
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(5)
+        self._target.close()
+        logging.Handler.close(self)
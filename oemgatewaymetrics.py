@@ -0,0 +1,254 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import BaseHTTPServer
+import collections
+import threading
+import socket
+import logging
+
+"""class OemGatewayMetrics
+
+Registry of metrics describing the gateway activity: counters, gauges and
+histograms, optionally with labels.
+
+Metrics must be declared with describe() before use. The gateway metrics are
+declared below, in the shared registry: metrics.
+
+The registry can be rendered in Prometheus text format, or summarized in a
+log line.
+
+Collectors are functions called before rendering, typically to update gauges.
+
+"""
+class OemGatewayMetrics(object):
+
+    # Default histogram buckets, in seconds
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        # {name: (type, help, buckets, {labels: value})}
+        self._metrics = collections.OrderedDict()
+        self._collectors = []
+
+    def describe(self, name, type, help, buckets=BUCKETS):
+        """Declare a metric.
+
+        name (string): metric name
+        type (string): 'counter', 'gauge' or 'histogram'
+        help (string): description
+        buckets (tuple): upper bounds of the buckets, for histograms
+
+        """
+
+        with self._lock:
+            self._metrics[name] = (type, help, tuple(buckets), {})
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter."""
+
+        key = tuple(sorted(labels.iteritems()))
+        with self._lock:
+            values = self._metrics[name][3]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+
+        key = tuple(sorted(labels.iteritems()))
+        with self._lock:
+            self._metrics[name][3][key] = value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram."""
+
+        key = tuple(sorted(labels.iteritems()))
+        with self._lock:
+            kind, help, buckets, values = self._metrics[name]
+            try:
+                counts = values[key]
+            except KeyError:
+                # Bucket counts, then sum and count
+                counts = values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def clear(self, name):
+        """Remove all values of a metric."""
+
+        with self._lock:
+            self._metrics[name][3].clear()
+
+    def add_collector(self, collector):
+        """Add a function to be called before rendering."""
+
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        """Remove a collector."""
+
+        self._collectors.remove(collector)
+
+    def _collect(self):
+        """Call collectors."""
+
+        for collector in list(self._collectors):
+            collector()
+
+    def render(self):
+        """Return metrics in Prometheus text format."""
+
+        self._collect()
+        lines = []
+        with self._lock:
+            for name, (kind, help, buckets, values) in \
+                    self._metrics.iteritems():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key, value in values.iteritems():
+                    if kind == 'histogram':
+                        for bound, count in zip(buckets, value):
+                            lines.append('%s_bucket%s %d' % (name,
+                                _labels(key + (('le', repr(bound)),)), count))
+                        lines.append('%s_bucket%s %d' % (name,
+                                _labels(key + (('le', '+Inf'),)), value[-1]))
+                        lines.append('%s_sum%s %r' % (name, _labels(key),
+                                                      value[-2]))
+                        lines.append('%s_count%s %d' % (name, _labels(key),
+                                                        value[-1]))
+                    else:
+                        lines.append('%s%s %r' % (name, _labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Return a one-line summary of the metrics.
+
+        Counters and gauges are summed over labels. Histograms are
+        summarized by their count and mean.
+
+        """
+
+        self._collect()
+        items = []
+        with self._lock:
+            for name, (kind, help, buckets, values) in \
+                    self._metrics.iteritems():
+                if not values:
+                    continue
+                if kind == 'histogram':
+                    count = sum(v[-1] for v in values.itervalues())
+                    total = sum(v[-2] for v in values.itervalues())
+                    items.append('%s: %d, mean %.3f' % (name, count,
+                                 total / count if count else 0))
+                else:
+                    items.append('%s: %s' % (name, sum(values.itervalues())))
+        return ', '.join(items)
+
+def _labels(key):
+    """Format labels in Prometheus text format."""
+
+    if not key:
+        return ''
+    return '{' + ','.join('%s="%s"' % (label, str(value)
+                          .replace('\\', '\\\\').replace('"', '\\"')
+                          .replace('\n', '\\n'))
+                          for label, value in key) + '}'
+
+"""class OemGatewayMetricsServer
+
+Serves metrics over HTTP, in Prometheus text format, in a background thread.
+
+"""
+class OemGatewayMetricsServer(object):
+
+    def __init__(self, registry, port, address='127.0.0.1'):
+        """Start server
+
+        registry (OemGatewayMetrics): metrics to serve
+        port (int): port number
+        address (string): address to listen on, '' for all interfaces
+
+        """
+
+        # Initialize logger
+        self._log = logging.getLogger("OemGateway")
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._log.info("Serving metrics on %s:%s", address or '*', port)
+        try:
+            self._server = BaseHTTPServer.HTTPServer((address, int(port)),
+                                                     Handler)
+        except socket.error as e:
+            raise OemGatewayMetricsError('Could not open %s:%s: %s' %
+                                         (address or '*', port, e))
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop server."""
+
+        self._server.shutdown()
+        self._server.server_close()
+
+"""class OemGatewayMetricsError
+
+Raise this when metrics server can't be started.
+
+"""
+class OemGatewayMetricsError(Exception):
+    pass
+
+# Shared registry
+metrics = OemGatewayMetrics()
+
+# Gateway metrics
+metrics.describe('oemgateway_frames_received_total', 'counter',
+                 'Valid frames received, by listener and node')
+metrics.describe('oemgateway_frames_malformed_total', 'counter',
+                 'Misformed frames received, by listener')
+metrics.describe('oemgateway_frames_filtered_total', 'counter',
+                 'Frames dropped as duplicates or over node rate, by reason')
+metrics.describe('oemgateway_buffer_queued', 'gauge',
+                 'Samples waiting to be sent, by buffer')
+metrics.describe('oemgateway_buffer_dropped_total', 'counter',
+                 'Samples dropped because the buffer was full, by buffer')
+metrics.describe('oemgateway_buffer_breaker_open', 'gauge',
+                 'Whether send attempts are suspended, by buffer')
+metrics.describe('oemgateway_samples_sent_total', 'counter',
+                 'Samples sent, by buffer')
+metrics.describe('oemgateway_send_failures_total', 'counter',
+                 'Failed send attempts, by buffer')
+metrics.describe('oemgateway_send_duration_seconds', 'histogram',
+                 'Duration of send attempts, by buffer')
+metrics.describe('oemgateway_loop_duration_seconds', 'histogram',
+                 'Duration of main loop iterations, excluding wait')
+metrics.describe('oemgateway_check_settings_duration_seconds', 'histogram',
+                 'Duration of settings checks and updates')
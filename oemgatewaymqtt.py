@@ -0,0 +1,245 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import socket
+import struct
+import time
+import logging
+
+# MQTT 3.1.1 packet types
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+DISCONNECT = 0xe0
+
+"""class OemGatewayMQTTClient
+
+Minimal MQTT 3.1.1 client, publishing messages with QoS 0 or 1.
+
+The connection is kept open between publications, and reopened when needed,
+or when settings change. Sessions are clean: messages not acknowledged when
+the connection is lost must be published again.
+
+Several messages can be published at once: they are all written before
+waiting for their acknowledgements, so that a round trip to the broker is
+not waited for each one.
+
+The client is not thread safe.
+
+"""
+class OemGatewayMQTTClient(object):
+
+    def __init__(self):
+
+        # Initialize logger
+        self._log = logging.getLogger("OemGateway")
+
+        # Connection settings, and settings of the current connection
+        self._params = None
+        self._conn_params = None
+        self._sock = None
+        self._fp = None
+        # Time of last packet sent, for keep alive
+        self._last_sent = 0
+        # Last packet identifier used
+        self._packet_id = 0
+
+        # Timeouts in seconds
+        self.connect_timeout = 10
+        self.read_timeout = 60
+
+    def set(self, domain, client_id='', username=None, password=None,
+            keepalive=60):
+        """Update connection settings, used from next publication.
+
+        domain (string): broker host name, optionally with port
+        (eg: 'localhost:1883')
+        client_id (string): client identifier, generated by broker if empty
+        username (string): user name, if any
+        password (string): password, if any
+        keepalive (string): keep alive interval in seconds
+
+        """
+
+        self._params = (domain, client_id, username, password, int(keepalive))
+
+    def publish(self, topic, payloads, qos=1):
+        """Publish messages, oldest first.
+
+        topic (string): topic name
+        payloads (list): messages payloads
+        qos (int): 0 (at most once) or 1 (at least once)
+
+        Return the number of messages published, oldest first. With QoS 1,
+        messages following the first one not acknowledged are not counted:
+        they may or may not have been received.
+
+        Raise socket.error or OemGatewayMQTTError if no message was
+        published.
+
+        """
+
+        # If the connection is reused, the broker may have closed it in the
+        # meantime. In this case, retry once on a new connection.
+        retry = self._sock is not None
+        while True:
+            acked = []
+            try:
+                self._publish(topic, payloads, qos, acked)
+                return len(acked)
+            except (socket.error, OemGatewayMQTTError):
+                self.close()
+                if acked:
+                    return len(acked)
+                if not retry:
+                    raise
+                self._log.debug("Connection to %s lost, reconnecting",
+                                self._params[0])
+                retry = False
+
+    def close(self):
+        """Disconnect from broker."""
+
+        if self._sock is not None:
+            try:
+                self._sock.sendall(_packet(DISCONNECT, ''))
+            except socket.error:
+                pass
+            self._sock.close()
+            self._sock = None
+            self._fp = None
+
+    def _connect(self):
+        """Connect to broker if needed."""
+
+        keepalive = self._params[4]
+        # Settings changed, or broker may have closed the connection after
+        # 1.5 keep alive interval without packet: reconnect
+        if self._sock is not None and (self._conn_params != self._params or
+           keepalive and time.time() - self._last_sent >= keepalive):
+            self.close()
+        if self._sock is not None:
+            return
+
+        domain, client_id, username, password, keepalive = self._params
+        host, sep, port = domain.partition(':')
+        self._log.debug("Opening connection to MQTT broker %s", domain)
+        sock = socket.create_connection((host, int(port or 1883)),
+                                        self.connect_timeout)
+        sock.settimeout(self.read_timeout)
+        self._sock = sock
+        self._fp = sock.makefile('rb')
+        self._conn_params = self._params
+
+        # Clean session
+        flags = 0x02
+        payload = _string(client_id)
+        if username:
+            flags |= 0x80
+            payload += _string(username)
+            if password:
+                flags |= 0x40
+                payload += _string(password)
+        self._send(_packet(CONNECT, _string('MQTT') +
+                           struct.pack('!BBH', 4, flags, keepalive) +
+                           payload))
+        packet_type, data = self._read()
+        if packet_type != CONNACK or len(data) != 2:
+            raise OemGatewayMQTTError("Unexpected packet from broker")
+        if ord(data[1]):
+            raise OemGatewayMQTTError("Connection refused by broker, "
+                                      "return code %d" % ord(data[1]))
+
+    def _publish(self, topic, payloads, qos, acked):
+        """Publish messages on current connection, opening it if needed.
+
+        acked (list): list the payloads published are appended to
+
+        """
+
+        self._connect()
+        header = PUBLISH | qos << 1
+        topic = _string(topic)
+        ids = []
+        packets = []
+        for payload in payloads:
+            if qos:
+                self._packet_id = self._packet_id % 0xffff + 1
+                ids.append(self._packet_id)
+                packets.append(_packet(header, topic +
+                               struct.pack('!H', self._packet_id) + payload))
+            else:
+                packets.append(_packet(header, topic + payload))
+        self._send(''.join(packets))
+        if not qos:
+            acked.extend(payloads)
+            return
+
+        # Acknowledgements come in order of publication
+        for packet_id, payload in zip(ids, payloads):
+            packet_type, data = self._read()
+            if packet_type != PUBACK or \
+               struct.unpack('!H', data[:2])[0] != packet_id:
+                raise OemGatewayMQTTError("Unexpected packet from broker")
+            acked.append(payload)
+
+    def _send(self, data):
+        """Send data to broker."""
+
+        self._sock.sendall(data)
+        self._last_sent = time.time()
+
+    def _read(self):
+        """Read a packet from broker, return (packet type, data)."""
+
+        header = self._fp.read(1)
+        # Remaining length: 7 bits per byte, least significant first
+        length = 0
+        for shift in range(0, 28, 7):
+            byte = self._fp.read(1)
+            if not byte:
+                break
+            length |= (ord(byte) & 0x7f) << shift
+            if not ord(byte) & 0x80:
+                break
+        data = self._fp.read(length)
+        if not header or len(data) != length:
+            raise OemGatewayMQTTError("Connection closed by broker")
+        return ord(header) & 0xf0, data
+
+def _string(s):
+    """Return a string encoded as in MQTT packets, prefixed by its length."""
+
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
+def _packet(header, data):
+    """Return a packet from its fixed header first byte and its data."""
+
+    length = len(data)
+    encoded = []
+    while True:
+        byte = length & 0x7f
+        length >>= 7
+        if length:
+            encoded.append(chr(byte | 0x80))
+        else:
+            encoded.append(chr(byte))
+            break
+    return chr(header) + ''.join(encoded) + data
+
+"""class OemGatewayMQTTError
+
+Raise this when the broker refuses the connection or breaks the protocol.
+
+"""
+class OemGatewayMQTTError(Exception):
+    pass
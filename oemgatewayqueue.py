@@ -0,0 +1,573 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import collections
+import array
+import json
+import sqlite3
+import time
+import logging
+import threading
+
+"""class OemGatewayQueue
+
+Stores samples waiting to be sent, in memory.
+
+Samples are of the form [timestamp, [node, val1, val2,...]].
+
+When the queue is full, oldest samples are dropped.
+
+This class is also the interface that other queue backends implement.
+
+"""
+class OemGatewayQueue(object):
+
+    def __init__(self, maxsize=1000):
+        """Initialize queue
+
+        maxsize (int): maximum number of samples held in the queue
+
+        """
+
+        # Initialize logger
+        self._log = logging.getLogger("OemGateway")
+
+        self._maxsize = int(maxsize)
+        self._queue = collections.deque()
+
+        # Number of samples dropped because the queue was full
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def append(self, sample):
+        """Append sample to queue, dropping oldest sample if queue is full."""
+
+        if len(self._queue) >= self._maxsize:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append(sample)
+
+    def peek(self, n=1):
+        """Return a list of the n oldest samples, without removing them."""
+
+        return [self._queue[i] for i in range(min(n, len(self._queue)))]
+
+    def pop(self, n=1):
+        """Remove the n oldest samples."""
+
+        for i in range(min(n, len(self._queue))):
+            self._queue.popleft()
+
+    def append_many(self, samples):
+        """Append samples to queue."""
+
+        for sample in samples:
+            self.append(sample)
+
+    def close(self):
+        """Close queue."""
+        pass
+
+"""class OemGatewaySQLiteQueue
+
+Stores samples waiting to be sent in a SQLite database, so that they survive
+a restart and a long connection loss does not fill the RAM.
+
+The database uses WAL journal mode, and changes are committed in batches
+to limit disk writes (typically on an SD card).
+
+"""
+class OemGatewaySQLiteQueue(OemGatewayQueue):
+
+    def __init__(self, filename, maxsize=1000, syncinterval=5):
+        """Initialize queue
+
+        filename (string): path to database file
+        maxsize (int): maximum number of samples held in the queue
+        syncinterval (int): max time in seconds between two commits
+
+        """
+
+        super(OemGatewaySQLiteQueue, self).__init__(maxsize)
+
+        self._syncinterval = float(syncinterval)
+
+        self._log.debug('Opening queue file: %s', filename)
+
+        # The queue is shared by main thread and sender thread. The caller
+        # is responsible for serializing the accesses.
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS samples '
+                         '(id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'time REAL, data TEXT)')
+        self._db.commit()
+
+        # Number of samples in queue
+        self._len = self._db.execute(
+            'SELECT COUNT(*) FROM samples').fetchone()[0]
+        if self._len:
+            self._log.info("Recovered %d samples from %s", self._len, filename)
+
+        # Time of last commit
+        self._sync_timestamp = time.time()
+
+    def __len__(self):
+        return self._len
+
+    def append(self, sample):
+        """Append sample to queue, dropping oldest sample if queue is full."""
+
+        t, data = sample
+        self._db.execute('INSERT INTO samples (time, data) VALUES (?, ?)',
+                         (t, json.dumps(data)))
+        self._len += 1
+        if self._len > self._maxsize:
+            self.dropped += self._len - self._maxsize
+            self.pop(self._len - self._maxsize)
+        self._sync()
+
+    def peek(self, n=1):
+        """Return a list of the n oldest samples, without removing them."""
+
+        return [[t, json.loads(data)] for t, data in self._db.execute(
+            'SELECT time, data FROM samples ORDER BY id LIMIT ?', (n,))]
+
+    def pop(self, n=1):
+        """Remove the n oldest samples."""
+
+        cursor = self._db.execute('DELETE FROM samples WHERE id IN '
+                                  '(SELECT id FROM samples ORDER BY id '
+                                  'LIMIT ?)', (n,))
+        self._len -= cursor.rowcount
+        self._sync()
+
+    def close(self):
+        """Commit pending changes and close database."""
+
+        self._db.commit()
+        self._db.close()
+
+    def _sync(self):
+        """Commit pending changes if last commit is old enough."""
+
+        now = time.time()
+        if now - self._sync_timestamp >= self._syncinterval:
+            self._db.commit()
+            self._sync_timestamp = now
+
+"""class OemGatewayArrayQueue
+
+Stores samples waiting to be sent in memory, in a compact form.
+
+Rather than a list per sample, samples are stored in a ring buffer of
+typed arrays: timestamps in an array of doubles, and nodes and values in an
+array of doubles with a fixed number of slots per sample. The number of
+slots is the max number of values seen, and grows if needed. Samples with
+more than 254 values are rare enough to be stored as lists.
+
+The type of the values (all ints, all floats, or mixed) is recorded, so that
+samples are returned as they were appended.
+
+"""
+class OemGatewayArrayQueue(OemGatewayQueue):
+
+    # Sample kinds
+    INTS, FLOATS, MIXED, WIDE = range(4)
+
+    def __init__(self, maxsize=1000):
+        """Initialize queue
+
+        maxsize (int): maximum number of samples held in the queue
+
+        """
+
+        super(OemGatewayArrayQueue, self).__init__(maxsize)
+
+        # Timestamps
+        self._times = array.array('d')
+        # Number of slots used by each sample (node and values)
+        self._lengths = array.array('B')
+        # Kind of each sample
+        self._kinds = array.array('B')
+        # Node and values of each sample, _width slots per sample
+        self._width = 1
+        self._slots = array.array('d')
+        # Which slots hold ints, for mixed samples: {index: [bool, ...]}
+        self._mixed = {}
+        # Samples with more slots than a length can count, stored as is:
+        # {index: [node, val1, val2, ...]}
+        self._wide = {}
+
+        # Index of oldest sample, and number of samples
+        self._head = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, sample):
+        """Append sample to queue, dropping oldest sample if queue is full."""
+
+        t, data = sample
+        length = len(data)
+        if length > 255:
+            # Too wide for the arrays: don't use any slot
+            kind = self.WIDE
+            length = 0
+        elif length > self._width:
+            self._widen(length)
+
+        if self._len >= self._maxsize:
+            self.pop(1)
+            self.dropped += 1
+
+        if length:
+            types = set(map(type, data))
+            if types == _INT_TYPES:
+                kind = self.INTS
+            elif types == _FLOAT_TYPES:
+                kind = self.FLOATS
+            else:
+                kind = self.MIXED
+
+        width = self._width
+        i = self._head + self._len
+        if i == len(self._times) < self._maxsize:
+            # Ring buffer not full yet: extend arrays
+            self._times.append(t)
+            self._lengths.append(length)
+            self._kinds.append(kind)
+            self._slots.extend(data[:length])
+            if length < width:
+                self._slots.extend(_ZEROS[:width - length])
+        else:
+            i %= self._maxsize
+            self._times[i] = t
+            self._lengths[i] = length
+            self._kinds[i] = kind
+            self._slots[i * width:i * width + length] = \
+                array.array('d', data[:length])
+            self._mixed.pop(i, None)
+            self._wide.pop(i, None)
+        if kind == self.MIXED:
+            self._mixed[i] = [isinstance(v, (int, long)) for v in data]
+        elif kind == self.WIDE:
+            self._wide[i] = list(data)
+        self._len += 1
+
+    def peek(self, n=1):
+        """Return a list of the n oldest samples, without removing them."""
+
+        width = self._width
+        size = len(self._times)
+        samples = []
+        for j in range(min(n, self._len)):
+            i = (self._head + j) % size
+            start = i * width
+            data = self._slots[start:start + self._lengths[i]].tolist()
+            kind = self._kinds[i]
+            if kind == self.INTS:
+                data = map(int, data)
+            elif kind == self.MIXED:
+                data = [int(v) if is_int else v
+                        for v, is_int in zip(data, self._mixed[i])]
+            elif kind == self.WIDE:
+                data = list(self._wide[i])
+            samples.append([self._times[i], data])
+        return samples
+
+    def pop(self, n=1):
+        """Remove the n oldest samples."""
+
+        n = min(n, self._len)
+        if not n:
+            return
+        self._len -= n
+        if self._len:
+            self._head = (self._head + n) % len(self._times)
+        else:
+            self._head = 0
+
+    def _widen(self, width):
+        """Increase the number of slots per sample."""
+
+        pad = _ZEROS[:width - self._width]
+        slots = array.array('d')
+        for i in range(len(self._times)):
+            start = i * self._width
+            slots.extend(self._slots[start:start + self._width])
+            slots.extend(pad)
+        self._slots = slots
+        self._width = width
+
+_INT_TYPES = set([int])
+_FLOAT_TYPES = set([float])
+_ZEROS = array.array('d', [0] * 256)
+
+"""class OemGatewaySharedLog
+
+Append-only log of samples shared by several buffers, so that a sample sent
+to several servers is stored once.
+
+Each buffer stores its samples in the log through its own 
+OemGatewaySharedLogQueue, which holds the ranges of offsets of its samples.
+When a queue appends samples with the same timestamp and the same data 
+objects as the last samples appended to the log by another queue, as when 
+the gateway passes a frame to all the buffers, the samples are not stored 
+again. Other samples (e.g. aggregated ones) are stored for this queue only.
+
+Samples are removed once all the queues have read past them. If the log 
+exceeds maxsize, oldest samples are removed anyway, and counted as dropped 
+by the queues that had not sent them.
+
+A shared log is available as shared_log.
+
+"""
+class OemGatewaySharedLog(object):
+
+    def __init__(self, maxsize=100000):
+        """Initialize log
+
+        maxsize (int): maximum number of samples held in the log
+
+        """
+
+        self.maxsize = int(maxsize)
+
+        # _lock protects the log and the state of its queues
+        self._lock = threading.Lock()
+        # Samples, from index _head. Sample at index _head has offset _base.
+        self._samples = []
+        self._head = 0
+        self._base = 0
+        self._queues = set()
+        # Last samples stored, and offset of the first one
+        self._last = []
+        self._last_offset = 0
+
+    def __len__(self):
+        return len(self._samples) - self._head
+
+    def queue(self, maxsize=1000):
+        """Return a new queue storing its samples in the log.
+
+        maxsize (int): maximum number of samples held in the queue
+
+        """
+
+        with self._lock:
+            queue = OemGatewaySharedLogQueue(self, maxsize)
+            self._queues.add(queue)
+        return queue
+
+    def _store(self, samples, queue):
+        """Store samples for a queue, unless they are the last samples
+        stored, for another queue. Call with lock held.
+
+        samples (list): [[timestamp, [node, val1, val2, ...]], ...]
+        queue (OemGatewaySharedLogQueue): queue the samples are stored for
+
+        Return the offsets of the first sample and following the last one.
+
+        """
+
+        start = self._last_offset
+        end = start + len(self._last)
+        if end == self._end() and start >= self._base and \
+           queue._last_end() <= start and _same(samples, self._last):
+            return start, end
+        start = self._end()
+        self._samples.extend(samples)
+        self._last = samples
+        self._last_offset = start
+        return start, start + len(samples)
+
+    def _end(self):
+        """Return the offset following the last sample."""
+
+        return self._base + len(self)
+
+    def _get(self, offset):
+        """Return the sample at offset."""
+
+        return self._samples[self._head + offset - self._base]
+
+    def _trim(self):
+        """Remove samples exceeding maxsize, then the samples all queues
+        have read past."""
+
+        if len(self) > self.maxsize:
+            self._remove(len(self) - self.maxsize)
+        self._compact()
+
+    def _compact(self):
+        """Remove the samples all queues have read past."""
+
+        offset = self._end()
+        for q in self._queues:
+            first = q._first()
+            if first is not None and first < offset:
+                offset = first
+        self._remove(offset - self._base)
+
+    def _remove(self, n):
+        """Remove the n oldest samples."""
+
+        if n <= 0:
+            return
+        offset = self._base + n
+        for q in self._queues:
+            q._remove_before(offset)
+        self._head += n
+        self._base = offset
+        # Free memory once the removed samples are a significant part
+        if self._head > 1024 and self._head * 2 > len(self._samples):
+            del self._samples[:self._head]
+            self._head = 0
+
+    def _close_queue(self, queue):
+        """Stop keeping samples for a queue."""
+
+        with self._lock:
+            self._queues.discard(queue)
+            self._compact()
+
+def _same(samples, last):
+    """Return True if samples have the same timestamps and data objects."""
+
+    if len(samples) != len(last):
+        return False
+    for (t, data), (last_t, last_data) in zip(samples, last):
+        if t != last_t or data is not last_data:
+            return False
+    return True
+
+"""class OemGatewaySharedLogQueue
+
+Queue of a buffer storing its samples in an OemGatewaySharedLog.
+
+The queue holds the ranges of offsets of its samples in the log.
+
+"""
+class OemGatewaySharedLogQueue(OemGatewayQueue):
+
+    def __init__(self, log, maxsize=1000):
+        """Initialize queue. Use OemGatewaySharedLog.queue() instead.
+
+        log (OemGatewaySharedLog): log the samples are stored in
+        maxsize (int): maximum number of samples held in the queue
+
+        """
+
+        super(OemGatewaySharedLogQueue, self).__init__(maxsize)
+
+        self._shared = log
+        # Ranges of offsets of the samples in the log, oldest first: 
+        # [[start, end], ...]
+        self._ranges = []
+        # Number of samples
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, sample):
+        """Append sample to queue, dropping oldest sample if queue is full."""
+
+        self.append_many([sample])
+
+    def append_many(self, samples):
+        """Append samples to queue, dropping oldest samples if queue is
+        full."""
+
+        if not samples:
+            return
+        with self._shared._lock:
+            start, end = self._shared._store(samples, self)
+            if self._ranges and self._ranges[-1][1] == start:
+                self._ranges[-1][1] = end
+            else:
+                self._ranges.append([start, end])
+            self._len += end - start
+            if self._len > self._maxsize:
+                self.dropped += self._len - self._maxsize
+                self._pop(self._len - self._maxsize)
+            self._shared._trim()
+
+    def peek(self, n=1):
+        """Return a list of the n oldest samples, without removing them."""
+
+        with self._shared._lock:
+            samples = []
+            for start, end in self._ranges:
+                for offset in range(start, min(end, start + n - len(samples))):
+                    samples.append(self._shared._get(offset))
+                if len(samples) >= n:
+                    break
+            return samples
+
+    def pop(self, n=1):
+        """Remove the n oldest samples."""
+
+        with self._shared._lock:
+            self._pop(n)
+            self._shared._compact()
+
+    def close(self):
+        """Stop storing samples in the log."""
+
+        self._shared._close_queue(self)
+
+    def _first(self):
+        """Return the offset of the oldest sample, None if empty."""
+
+        if self._ranges:
+            return self._ranges[0][0]
+
+    def _last_end(self):
+        """Return the offset following the last sample, -1 if empty."""
+
+        if self._ranges:
+            return self._ranges[-1][1]
+        return -1
+
+    def _pop(self, n):
+        """Remove the n oldest samples. Call with log lock held."""
+
+        n = min(n, self._len)
+        self._len -= n
+        while n:
+            r = self._ranges[0]
+            count = min(n, r[1] - r[0])
+            r[0] += count
+            n -= count
+            if r[0] == r[1]:
+                self._ranges.pop(0)
+
+    def _remove_before(self, offset):
+        """Samples before offset are removed from the log: count the ones
+        not sent as dropped. Call with log lock held."""
+
+        dropped = 0
+        while self._ranges and self._ranges[0][0] < offset:
+            r = self._ranges[0]
+            dropped += min(r[1], offset) - r[0]
+            if r[1] <= offset:
+                self._ranges.pop(0)
+            else:
+                r[0] = offset
+        self._len -= dropped
+        self.dropped += dropped
+
+# Shared log
+shared_log = OemGatewaySharedLog()
@@ -0,0 +1,101 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+"""class OemGatewaySettingsDiff
+
+Differences between two sets of gateway settings, as described in
+OemGatewayInterface.
+
+Attributes:
+gateway (set): gateway settings added, removed or modified
+listeners (OemGatewayComponentsDiff): differences in listeners
+buffers (OemGatewayComponentsDiff): differences in buffers
+
+"""
+class OemGatewaySettingsDiff(object):
+
+    def __init__(self, old, new):
+        """Compare settings
+
+        old (dict): previous settings
+        new (dict): new settings
+
+        """
+
+        self.gateway = _changed_keys(old.get('gateway', {}),
+                                     new.get('gateway', {}))
+        self.listeners = OemGatewayComponentsDiff(old.get('listeners', {}),
+                                                  new.get('listeners', {}))
+        self.buffers = OemGatewayComponentsDiff(old.get('buffers', {}),
+                                                new.get('buffers', {}))
+
+    def __nonzero__(self):
+        return bool(self.gateway or self.listeners or self.buffers)
+
+"""class OemGatewayComponentsDiff
+
+Differences between two sets of listeners or buffers settings.
+
+Components whose type or init settings were modified can't be updated: they
+must be deleted and created again. Components whose runtime settings only
+were modified can be updated with their set() method.
+
+Attributes:
+added (list): names of new components
+removed (list): names of components not in settings anymore
+replaced (list): names of components whose type or init settings changed
+modified (dict): components whose runtime settings only changed,
+{name: {setting: new value}}, with added and modified settings only
+unset (dict): components whose runtime settings were removed,
+{name: [setting, ...]}
+
+"""
+class OemGatewayComponentsDiff(object):
+
+    def __init__(self, old, new):
+        """Compare components settings
+
+        old (dict): previous components settings, by name
+        new (dict): new components settings, by name
+
+        """
+
+        self.added = sorted(name for name in new if name not in old)
+        self.removed = sorted(name for name in old if name not in new)
+        self.replaced = []
+        self.modified = {}
+        self.unset = {}
+
+        for name in sorted(new):
+            if name not in old or new[name] == old[name]:
+                continue
+            o, n = old[name], new[name]
+            if o.get('type') != n.get('type') or \
+               o.get('init_settings') != n.get('init_settings'):
+                self.replaced.append(name)
+                continue
+            o = o.get('runtime_settings', {})
+            n = n.get('runtime_settings', {})
+            changed = dict((key, value) for key, value in n.iteritems()
+                           if key not in o or o[key] != value)
+            if changed:
+                self.modified[name] = changed
+            unset = sorted(key for key in o if key not in n)
+            if unset:
+                self.unset[name] = unset
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.replaced or
+                    self.modified or self.unset)
+
+def _changed_keys(old, new):
+    """Return the set of keys added, removed or modified."""
+
+    return set(key for key in set(old) | set(new)
+               if key not in old or key not in new or old[key] != new[key])